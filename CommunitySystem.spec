@@ -5,12 +5,12 @@ a = Analysis(
     ['launcher.py'],
     pathex=[],
     binaries=[],
-    datas=[('templates', 'templates'), ('database.py', '.'), ('app.py', '.')],
-    hiddenimports=['flask', 'sqlite3', 'dateutil', 'webbrowser', 'threading'],
+    datas=[('templates', 'templates'), ('static_pages', 'static_pages'), ('database.py', '.'), ('app.py', '.')],
+    hiddenimports=['flask', 'sqlite3', 'webbrowser', 'threading'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=['tkinter'],
     noarchive=False,
     optimize=0,
 )
@@ -19,16 +19,13 @@ pyz = PYZ(a.pure)
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.datas,
     [],
+    exclude_binaries=True,
     name='CommunitySystem',
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
-    upx_exclude=[],
-    runtime_tmpdir=None,
+    upx=False,
     console=False,
     disable_windowed_traceback=False,
     argv_emulation=False,
@@ -37,3 +34,12 @@ exe = EXE(
     entitlements_file=None,
     icon='NONE',
 )
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='CommunitySystem',
+)
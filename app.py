@@ -1,12 +1,96 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
-from database import get_db, init_db, calculate_quarter
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context, get_flashed_messages
+from database import get_db, init_db, calculate_quarter, date_key, COST_FLAG_LABOR, COST_FLAGS, DATABASE
+from archive import attach_for_period, summary_totals, summary_by_type, summary_cost_breakdown, merge_rows
+from changes import fetch_changes, DEFAULT_BATCH
+from notify import subscribe, unsubscribe, publish, messages_since
+from distributions import allocated_percentage, MAX_PERCENTAGE, PERCENTAGE_PLACES
+from templating import init_templating
+from prerender import serve_prerendered
+from cache import reference_rows, reset as reset_reference_cache
+from events_api import fetch_events, bulk_set_status, bulk_delete, parse_ids, parse_list, MAX_IDS as MAX_EVENT_IDS
+from budget import init_budget, exceeded as budget_exceeded, paused as budget_paused, metrics as budget_metrics, MESSAGE as BUDGET_MESSAGE
+from shards import init_sharding, spans_shards, fan_out, shard_groups, shard_orgs, needs_move, move_event
 from datetime import datetime, date, timedelta
+from itertools import islice
 import calendar
+import functools
+import heapq
+import json
+import math
+import operator
+import os
+import queue
+import re
+import secrets
+import sqlite3
+import sys
+import time
+
+def load_secret_key(path):
+    # one random key per install, shared by every worker on this host: the
+    # first to create the file (O_EXCL) writes the key, the others read it.
+    # Owner-only, since it signs sessions; no hard links needed (FAT drives)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    except FileExistsError:
+        # a worker starting alongside may not have written it yet
+        for _ in range(50):
+            with open(path) as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.1)
+        raise RuntimeError(f'{path} is empty - delete it to generate a new key')
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key)
+    return key
 
 app = Flask(__name__)
-app.secret_key = 'community_system_secret_key'
+# sessions (and flash messages) are signed cookies, so any worker can read
+# them as long as all share the key - set SECRET_KEY when running on several hosts
+app.secret_key = os.environ.get('SECRET_KEY') or load_secret_key(
+    os.path.join(os.path.dirname(os.path.abspath(DATABASE)), '.secret_key'))
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
-app.config['TEMPLATES_AUTO_RELOAD'] = True
+
+# PRODUCTION=1 (and the frozen desktop exe) stops per-request template checks
+PRODUCTION = os.environ.get('PRODUCTION') == '1' or getattr(sys, 'frozen', False)
+app.config['TEMPLATES_AUTO_RELOAD'] = not PRODUCTION
+init_templating(app, os.environ.get('TEMPLATE_CACHE_DIR',
+                                    os.path.join(os.path.dirname(os.path.abspath(DATABASE)), '.jinja_cache')))
+# serve the static_pages/ built by prerender.py (kept live in development)
+app.config['SERVE_PRERENDERED'] = PRODUCTION
+# stream big list/report pages row by row instead of building them in memory
+app.config['STREAM_TEMPLATES'] = os.environ.get('STREAM_TEMPLATES', '1') == '1'
+# a streamed list holds a read snapshot, which stops WAL checkpoints, so it
+# is cut short after this long however slow the client is
+app.config['STREAM_SECONDS'] = float(os.environ.get('STREAM_SECONDS', 120))
+# a /stream connection holds a worker thread, so it is closed after this long;
+# the browser reconnects by itself and catches up from its last event id
+app.config['LIVE_STREAM_SECONDS'] = float(os.environ.get('LIVE_STREAM_SECONDS', 300))
+
+# per-request query budgets so a runaway report can't hold a worker (see budget.py)
+app.config['QUERY_BUDGET_SECONDS'] = float(os.environ.get('QUERY_BUDGET_SECONDS', 10))
+app.config['QUERY_BUDGET_STEPS'] = int(os.environ.get('QUERY_BUDGET_STEPS', 0))
+app.config['QUERY_BUDGETS'] = {
+    'generate_report': {'seconds': float(os.environ.get('REPORT_BUDGET_SECONDS', 30))},
+    'api_query_budget': None,
+}
+init_budget(app)
+
+# per-organization shard files when SHARDS_DIR is set (see shards.py)
+init_sharding(app)
+
+# any FLASK_<KEY> environment variable overrides app.config[KEY]
+# (values are parsed as JSON, e.g. FLASK_QUERY_BUDGET_SECONDS=5)
+app.config.from_prefixed_env()
+
+# scheduled online backups, e.g. BACKUP_INTERVAL_HOURS=24 (see backup.py)
+if os.environ.get('BACKUP_INTERVAL_HOURS'):
+    from backup import start_scheduler as start_backup_scheduler
+    start_backup_scheduler(float(os.environ['BACKUP_INTERVAL_HOURS']),
+                           compress=os.environ.get('BACKUP_COMPRESS') == '1',
+                           keep=int(os.environ.get('BACKUP_KEEP', 7)))
 
 def get_date_range(period, year=None, quarter=None):
     # get date range for filtering
@@ -27,12 +111,181 @@ def get_date_range(period, year=None, quarter=None):
             year = today.year
         start = date(year, 1, 1)
         end = date(year, 12, 31)
-    else:  # to_date - show everything
-        start = date(2000, 1, 1)
+    else:  # to_date - show everything, no lower bound
+        start = None
         end = today
     
     return start, end
 
+def request_date_range():
+    # get_date_range for ?period=&year=&quarter=, raising ValueError for a
+    # year or quarter date() can't take
+    year = request.args.get('year', type=int)
+    quarter = request.args.get('quarter', type=int)
+    if year is not None and not 1 <= year <= 9999:
+        raise ValueError('year must be between 1 and 9999')
+    if quarter is not None and not 1 <= quarter <= 4:
+        raise ValueError('quarter must be between 1 and 4')
+    return get_date_range(request.args.get('period', 'to_date'), year, quarter)
+
+def date_range_filter(start, end):
+    # filter on the indexed integer event_day so the range is an index scan
+    if start is None:
+        return ['ep.event_day <= ?'], [date_key(end)]
+    return ['ep.event_day BETWEEN ? AND ?'], [date_key(start), date_key(end)]
+
+def event_day_key(event):
+    # sort key matching ORDER BY ep.event_day (NULLs sort lowest)
+    return event['event_day'] or 0
+
+def event_years(cursor, across_shards=True):
+    """Years with events (hot or archived), newest first"""
+    # hop down the event_day index one year at a time instead of DISTINCT over every event
+    cursor.execute('''
+        WITH RECURSIVE y(day) AS (
+            SELECT MAX(event_day) FROM event_profiles
+            UNION ALL
+            SELECT (SELECT MAX(event_day) FROM event_profiles WHERE event_day < y.day / 10000 * 10000)
+            FROM y WHERE y.day IS NOT NULL
+        )
+        SELECT day / 10000 as year FROM y WHERE day IS NOT NULL
+        UNION SELECT year FROM archived_years ORDER BY year DESC
+    ''')
+    years = [row['year'] for row in cursor.fetchall()]
+    if across_shards and spans_shards():
+        years = sorted(set(years).union(*fan_out(lambda cursor, org: event_years(cursor, False))), reverse=True)
+    return years
+
+def event_quarters(cursor, across_shards=True):
+    """Quarters with events (hot or archived), newest first"""
+    cursor.execute('''
+        WITH RECURSIVE q(day) AS (
+            SELECT MAX(event_day) FROM event_profiles
+            UNION ALL
+            SELECT (SELECT MAX(event_day) FROM event_profiles
+                    WHERE event_day < q.day / 10000 * 10000 + ((q.day / 100 % 100 - 1) / 3 * 3 + 1) * 100)
+            FROM q WHERE q.day IS NOT NULL
+        )
+        SELECT (day / 10000) || 'Q' || ((day / 100 % 100 - 1) / 3 + 1) as quarter FROM q WHERE day IS NOT NULL
+        UNION SELECT quarter FROM archive_summaries WHERE quarter IS NOT NULL ORDER BY quarter DESC
+    ''')
+    quarters = [row['quarter'] for row in cursor.fetchall()]
+    if across_shards and spans_shards():
+        quarters = sorted(set(quarters).union(*fan_out(lambda cursor, org: event_quarters(cursor, False))), reverse=True)
+    return quarters
+
+class RowStream:
+    """Lazily iterate a cursor's rows in a streamed template.
+    
+    Truthiness peeks at the first row so `{% if events %}` still works. The
+    connection is closed once the rows are used up, straight away if there
+    are none, and at the latest when the response closes (render_page).
+    While open, the stream holds a WAL read snapshot that keeps checkpoints
+    from finishing, so it stops after STREAM_SECONDS.
+    If the request runs out of query budget (or time) mid-list the rows just
+    stop and `truncated` is set, since a streamed page can't turn into an
+    error any more.
+    """
+    def __init__(self, conn, cursor, batch_size=500):
+        self.conn = conn
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.truncated = False
+        self.deadline = time.monotonic() + app.config['STREAM_SECONDS']
+        self.first = cursor.fetchone()
+        if self.first is None:
+            self.close()
+    
+    def __bool__(self):
+        return self.first is not None
+    
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+    
+    def __iter__(self):
+        try:
+            if self.first is None:
+                return
+            # time spent handing rows to the template and a slow client
+            # isn't query time, so the budget clock stops meanwhile
+            with budget_paused():
+                yield self.first
+            while True:
+                if time.monotonic() > self.deadline:
+                    self.truncated = True
+                    break
+                rows = self.cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                with budget_paused():
+                    yield from rows
+        except sqlite3.OperationalError:
+            if not budget_exceeded():
+                raise
+            self.truncated = True
+        finally:
+            self.close()
+
+def render_page(template_name, **context):
+    # render a page that may hold RowStreams - streamed, or in one go if
+    # STREAM_TEMPLATES is off
+    if not app.config['STREAM_TEMPLATES']:
+        streams = [v for v in context.values() if isinstance(v, RowStream)]
+        context = {k: list(v) if isinstance(v, RowStream) else v for k, v in context.items()}
+        if any(s.truncated for s in streams):
+            flash(BUDGET_MESSAGE, 'error')
+        return render_template(template_name, **context)
+    # the session cookie goes out before the body, so pop flashes now
+    get_flashed_messages(with_categories=True)
+    template = app.jinja_env.get_or_select_template(template_name)
+    app.update_template_context(context)
+    stream = template.stream(context)
+    stream.enable_buffering(20)
+    response = Response(stream_with_context(stream))
+    # a stream the template never iterated still gives its connection back
+    for value in context.values():
+        if isinstance(value, RowStream):
+            response.call_on_close(value.close)
+    return response
+
+def refresh_event_totals(cursor, event_id):
+    # recompute the stored income/expense/net for one event from its cost entries
+    cursor.execute('''
+        SELECT COALESCE(SUM(CASE WHEN is_income = 1 THEN amount END), 0),
+               COALESCE(SUM(CASE WHEN is_income = 0 THEN amount END), 0)
+        FROM cost_entries WHERE event_id = ?
+    ''', (event_id,))
+    total_income, total_expense = cursor.fetchone()
+    # only write if they moved, so page views don't hit the change log
+    cursor.execute('''
+        UPDATE event_profiles SET total_income = ?, total_expense = ?, net_profit = ?
+        WHERE id = ? AND (total_income IS NOT ? OR total_expense IS NOT ?)
+    ''', (total_income, total_expense, total_income - total_expense, event_id, total_income, total_expense))
+    return total_income, total_expense
+
+def publish_event_totals(cursor, event_id, income=0, expense=0, labor_value=0):
+    # tell open dashboards/edit pages about a committed change (see /stream)
+    cursor.execute('''
+        SELECT ep.event_day, ep.organization_id, ep.total_income, ep.total_expense, ep.net_profit,
+               (SELECT COALESCE(SUM(amount), 0) FROM profit_distributions WHERE event_id = ep.id) as distributed
+        FROM event_profiles ep WHERE ep.id = ?
+    ''', (event_id,))
+    event = cursor.fetchone()
+    if not event:
+        return
+    publish({
+        'event_id': event_id,
+        'event_day': event['event_day'],
+        'organization_id': event['organization_id'],
+        'total_income': event['total_income'],
+        'total_expense': event['total_expense'],
+        'net_profit': event['net_profit'],
+        'distributed': event['distributed'],
+        'delta': {'income': income, 'expense': expense, 'labor_value': labor_value},
+    })
+
 @app.route('/')
 def index():
     # dashboard with filters
@@ -46,9 +299,11 @@ def index():
     conn = get_db()
     cursor = conn.cursor()
     
+    # closed years live in cold storage; attach the year file if needed
+    schema = attach_for_period(conn, start_date, end_date)
+    
     # build query filters
-    where_clauses = ['ep.event_date BETWEEN ? AND ?']
-    params = [start_date, end_date]
+    where_clauses, params = date_range_filter(start_date, end_date)
     
     if org_id:
         where_clauses.append('ep.organization_id = ?')
@@ -56,52 +311,71 @@ def index():
     
     where_sql = ' AND '.join(where_clauses)
     
-    # Statistics
-    cursor.execute(f'SELECT COUNT(*) FROM event_profiles ep WHERE {where_sql}', params)
-    total_events = cursor.fetchone()[0]
-    
-    cursor.execute(f'''
-        SELECT COALESCE(SUM(hours * rate_per_hour), 0) 
-        FROM cost_entries ce 
-        JOIN event_profiles ep ON ce.event_id = ep.id 
-        WHERE {where_sql} AND ce.cost_type_name = "Labor"
-    ''', params)
-    total_labor_value = cursor.fetchone()[0]
-    
-    cursor.execute(f'''
-        SELECT COALESCE(SUM(amount), 0) 
-        FROM cost_entries ce 
-        JOIN event_profiles ep ON ce.event_id = ep.id 
-        WHERE {where_sql} AND ce.is_income = 1
-    ''', params)
-    total_income = cursor.fetchone()[0]
-    
-    cursor.execute(f'''
-        SELECT COALESCE(SUM(amount), 0) 
-        FROM cost_entries ce 
-        JOIN event_profiles ep ON ce.event_id = ep.id 
-        WHERE {where_sql} AND ce.is_income = 0
-    ''', params)
-    total_expense = cursor.fetchone()[0]
-    
-    # Recent events
-    cursor.execute(f'''
-        SELECT ep.*, et.name as event_type_name, o.name as org_name
-        FROM event_profiles ep 
-        LEFT JOIN event_types et ON ep.event_type_id = et.id 
-        LEFT JOIN organizations o ON ep.organization_id = o.id
-        WHERE {where_sql}
-        ORDER BY ep.event_date DESC LIMIT 5
-    ''', params)
-    recent_events = cursor.fetchall()
+    # for a bounded period start from the event_day range, not the cost type
+    # index (the unary + keeps the planner off idx_cost_entries_type)
+    type_col = 'ce.cost_type_id' if start_date is None else '+ce.cost_type_id'
+    
+    def dashboard_figures(cursor, org=None):
+        # Statistics
+        cursor.execute(f'SELECT COUNT(*) FROM {schema}event_profiles ep WHERE {where_sql}', params)
+        total_events = cursor.fetchone()[0]
+        
+        cursor.execute(f'''
+            SELECT COALESCE(SUM(hours * rate_per_hour), 0) 
+            FROM {schema}cost_entries ce 
+            JOIN {schema}event_profiles ep ON ce.event_id = ep.id 
+            WHERE {where_sql} AND {type_col} IN (SELECT id FROM cost_types WHERE flags & ?)
+        ''', params + [COST_FLAG_LABOR])
+        total_labor_value = cursor.fetchone()[0]
+        
+        cursor.execute(f'''
+            SELECT COALESCE(SUM(amount), 0) 
+            FROM {schema}cost_entries ce 
+            JOIN {schema}event_profiles ep ON ce.event_id = ep.id 
+            WHERE {where_sql} AND ce.is_income = 1
+        ''', params)
+        total_income = cursor.fetchone()[0]
+        
+        cursor.execute(f'''
+            SELECT COALESCE(SUM(amount), 0) 
+            FROM {schema}cost_entries ce 
+            JOIN {schema}event_profiles ep ON ce.event_id = ep.id 
+            WHERE {where_sql} AND ce.is_income = 0
+        ''', params)
+        total_expense = cursor.fetchone()[0]
+        
+        # Recent events
+        cursor.execute(f'''
+            SELECT ep.*, et.name as event_type_name, o.name as org_name
+            FROM {schema}event_profiles ep 
+            LEFT JOIN event_types et ON ep.event_type_id = et.id 
+            LEFT JOIN organizations o ON ep.organization_id = o.id
+            WHERE {where_sql}
+            ORDER BY ep.event_day DESC LIMIT 5
+        ''', params)
+        return total_events, total_labor_value, total_income, total_expense, cursor.fetchall()
+    
+    if not schema and spans_shards():
+        # every organization's hot events: add up each shard's figures
+        parts = fan_out(dashboard_figures)
+        total_events, total_labor_value, total_income, total_expense = (sum(p[i] for p in parts) for i in range(4))
+        recent_events = list(islice(heapq.merge(*(p[4] for p in parts), key=event_day_key, reverse=True), 5))
+    else:
+        total_events, total_labor_value, total_income, total_expense, recent_events = dashboard_figures(cursor)
+    
+    # to_date also covers archived years, via their summary rows
+    if start_date is None:
+        archived = summary_totals(cursor, org_id)
+        total_events += archived['events']
+        total_labor_value += archived['labor_value']
+        total_income += archived['income']
+        total_expense += archived['expense']
     
     # Get organizations for filter
-    cursor.execute('SELECT * FROM organizations ORDER BY name')
-    organizations = cursor.fetchall()
+    organizations = reference_rows(cursor, 'organizations')
     
     # Get available years
-    cursor.execute('SELECT DISTINCT year FROM event_profiles WHERE year IS NOT NULL ORDER BY year DESC')
-    years = [row['year'] for row in cursor.fetchall()]
+    years = event_years(cursor)
     
     conn.close()
     
@@ -120,18 +394,22 @@ def index():
 @app.route('/events')
 def event_list():
     # Show all events
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
+    events_sql = '''
         SELECT ep.*, et.name as event_type_name, o.name as org_name
         FROM event_profiles ep 
         LEFT JOIN event_types et ON ep.event_type_id = et.id 
         LEFT JOIN organizations o ON ep.organization_id = o.id
-        ORDER BY ep.event_date DESC
-    ''')
-    events = cursor.fetchall()
-    conn.close()
-    return render_template('event_list.html', events=events)
+        ORDER BY ep.event_day DESC
+    '''
+    if spans_shards():
+        # each shard's events, merged newest first
+        parts = fan_out(lambda cursor, org: cursor.execute(events_sql).fetchall())
+        return render_page('event_list.html', events=list(heapq.merge(*parts, key=event_day_key, reverse=True)))
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(events_sql)
+    # rows are read while the page streams; RowStream closes conn
+    return render_page('event_list.html', events=RowStream(conn, cursor))
 
 @app.route('/events/add', methods=['GET', 'POST'])
 def add_event():
@@ -175,10 +453,8 @@ def add_event():
         flash('Event added successfully!', 'success')
         return redirect(url_for('edit_event', event_id=event_id))
     
-    cursor.execute('SELECT * FROM event_types')
-    event_types = cursor.fetchall()
-    cursor.execute('SELECT * FROM organizations ORDER BY name')
-    organizations = cursor.fetchall()
+    event_types = reference_rows(cursor, 'event_types')
+    organizations = reference_rows(cursor, 'organizations')
     cursor.execute('SELECT * FROM lens_categories ORDER BY name')
     lens_categories = cursor.fetchall()
     
@@ -215,25 +491,33 @@ def view_event(event_id):
     
     # Get cost entries grouped by type
     cursor.execute('''
-        SELECT cost_type_name, SUM(amount) as total, SUM(hours) as total_hours
-        FROM cost_entries WHERE event_id = ? AND is_income = 0
-        GROUP BY cost_type_name
+        SELECT ce.cost_type_id, COALESCE(ct.name, MAX(ce.cost_type_name)) as cost_type_name,
+               SUM(ce.hours) as hours,
+               SUM(CASE WHEN ce.is_income = 1 THEN ce.amount ELSE 0 END) as income,
+               SUM(CASE WHEN ce.is_income = 0 THEN ce.amount ELSE 0 END) as expense
+        FROM cost_entries ce
+        LEFT JOIN cost_types ct ON ce.cost_type_id = ct.id
+        WHERE ce.event_id = ?
+        GROUP BY ce.cost_type_id
     ''', (event_id,))
-    expenses = cursor.fetchall()
+    breakdown = cursor.fetchall()
+    totals = {
+        'total_hours': sum(b['hours'] or 0 for b in breakdown),
+        'total_income': sum(b['income'] or 0 for b in breakdown),
+        'total_expense': sum(b['expense'] or 0 for b in breakdown),
+    }
     
+    # Get profit distributions
     cursor.execute('''
-        SELECT cost_type_name, SUM(amount) as total
-        FROM cost_entries WHERE event_id = ? AND is_income = 1
-        GROUP BY cost_type_name
+        SELECT pd.*, o.name as org_name
+        FROM profit_distributions pd
+        LEFT JOIN organizations o ON pd.target_organization_id = o.id
+        WHERE pd.event_id = ?
     ''', (event_id,))
-    income = cursor.fetchall()
-    
-    # Get profit distributions
-    cursor.execute('SELECT * FROM profit_distributions WHERE event_id = ?', (event_id,))
     distributions = cursor.fetchall()
     
     conn.close()
-    return render_template('view_event.html', event=event, expenses=expenses, income=income, distributions=distributions)
+    return render_template('view_event.html', event=event, breakdown=breakdown, totals=totals, distributions=distributions)
 
 
 @app.route('/events/<int:event_id>/edit', methods=['GET', 'POST'])
@@ -267,16 +551,19 @@ def edit_event(event_id):
             quarter_str, year, event_id
         ))
         conn.commit()
+        # another organization's events live in its own shard
+        if needs_move(request.form.get('organization_id', type=int)):
+            conn.close()
+            move_event(event_id, request.form.get('organization_id', type=int))
+            flash('Event updated successfully!', 'success')
+            return redirect(url_for('edit_event', event_id=event_id))
         flash('Event updated successfully!', 'success')
     
     cursor.execute('SELECT * FROM event_profiles WHERE id = ?', (event_id,))
     event = cursor.fetchone()
-    cursor.execute('SELECT * FROM event_types')
-    event_types = cursor.fetchall()
-    cursor.execute('SELECT * FROM organizations ORDER BY name')
-    organizations = cursor.fetchall()
-    cursor.execute('SELECT * FROM cost_types ORDER BY name')
-    cost_types = cursor.fetchall()
+    event_types = reference_rows(cursor, 'event_types')
+    organizations = reference_rows(cursor, 'organizations')
+    cost_types = reference_rows(cursor, 'cost_types')
     cursor.execute('SELECT * FROM cost_entries WHERE event_id = ? ORDER BY created_at DESC', (event_id,))
     cost_entries = cursor.fetchall()
     cursor.execute('SELECT * FROM profit_distributions WHERE event_id = ?', (event_id,))
@@ -284,17 +571,8 @@ def edit_event(event_id):
     cursor.execute('SELECT * FROM volunteers ORDER BY name')
     volunteers = cursor.fetchall()
     
-    # Calculate totals
-    cursor.execute('SELECT COALESCE(SUM(amount), 0) FROM cost_entries WHERE event_id = ? AND is_income = 1', (event_id,))
-    total_income = cursor.fetchone()[0]
-    cursor.execute('SELECT COALESCE(SUM(amount), 0) FROM cost_entries WHERE event_id = ? AND is_income = 0', (event_id,))
-    total_expense = cursor.fetchone()[0]
-    
-    # Update event totals
-    cursor.execute('''
-        UPDATE event_profiles SET total_income = ?, total_expense = ?, net_profit = ?
-        WHERE id = ?
-    ''', (total_income, total_expense, total_income - total_expense, event_id))
+    # Calculate and store totals
+    total_income, total_expense = refresh_event_totals(cursor, event_id)
     conn.commit()
     
     conn.close()
@@ -304,40 +582,119 @@ def edit_event(event_id):
                          volunteers=volunteers, total_income=total_income,
                          total_expense=total_expense, net_profit=total_income - total_expense)
 
-@app.route('/events/<int:event_id>/costs/add', methods=['POST'])
-def add_cost_entry(event_id):
-    """Add cost entry"""
-    conn = get_db()
-    cursor = conn.cursor()
+def prepare_cost_entries(cursor, event_id, entries):
+    # validate and price a batch of cost entries (form rows or JSON objects)
+    # returns (rows ready for executemany, KPI deltas, errors)
+    cost_types = {row['id']: row for row in reference_rows(cursor, 'cost_types')}
     
-    cost_type_id = request.form.get('cost_type_id')
-    cursor.execute('SELECT name, default_rate FROM cost_types WHERE id = ?', (cost_type_id,))
-    cost_type = cursor.fetchone()
+    volunteer_ids = {str(e.get('volunteer_id')) for e in entries if e.get('volunteer_id')}
+    volunteers = {}
+    if volunteer_ids:
+        placeholders = ','.join('?' * len(volunteer_ids))
+        cursor.execute(f'SELECT id, name FROM volunteers WHERE id IN ({placeholders})', list(volunteer_ids))
+        volunteers = {str(row['id']): row['name'] for row in cursor.fetchall()}
     
-    hours = float(request.form.get('hours') or 0)
-    rate = float(request.form.get('rate_per_hour') or cost_type['default_rate'] if cost_type else 0)
-    amount = float(request.form.get('amount') or 0)
-    
-    if hours > 0 and rate > 0:
-        amount = hours * rate
+    rows, errors = [], []
+    delta = {'income': 0, 'expense': 0, 'labor_value': 0}
+    for i, entry in enumerate(entries, 1):
+        try:
+            cost_type_id = int(entry.get('cost_type_id') or 0) or None
+            hours = float(entry.get('hours') or 0)
+            amount = float(entry.get('amount') or 0)
+            rate = entry.get('rate_per_hour')
+            cost_type = cost_types.get(cost_type_id)
+            rate = float(rate) if rate not in (None, '') else (cost_type['default_rate'] if cost_type else 0)
+        except (TypeError, ValueError):
+            errors.append(f'Row {i}: cost type, hours, rate and amount must be numbers')
+            continue
+        # float() takes "nan", "inf" and "1e400"; an infinite amount would stick
+        # in the event's stored totals (hours * rate can overflow too)
+        if not all(math.isfinite(v) for v in (hours, rate, amount, hours * rate)):
+            errors.append(f'Row {i}: cost type, hours, rate and amount must be numbers')
+            continue
+        if cost_type_id and not cost_type:
+            errors.append(f'Row {i}: unknown cost type {cost_type_id}')
+            continue
+        if hours < 0 or rate < 0 or amount < 0:
+            errors.append(f'Row {i}: hours, rate and amount cannot be negative')
+            continue
+        volunteer_id = entry.get('volunteer_id') or None
+        if volunteer_id and str(volunteer_id) not in volunteers:
+            errors.append(f'Row {i}: unknown volunteer {volunteer_id}')
+            continue
+        
+        if hours > 0 and rate > 0:
+            amount = hours * rate
+        is_income = entry.get('is_income') in ('yes', True, 1, '1')
+        cost_type_name = cost_type['name'] if cost_type else 'Other'
+        rows.append((
+            event_id, cost_type_id, cost_type_name,
+            entry.get('description'),
+            hours, rate, amount,
+            volunteer_id,
+            entry.get('volunteer_name') or volunteers.get(str(volunteer_id)),
+            entry.get('volunteer_contact'),
+            1 if is_income else 0
+        ))
+        delta['income' if is_income else 'expense'] += amount
+        if cost_type and cost_type['flags'] & COST_FLAG_LABOR:
+            delta['labor_value'] += hours * rate
     
-    cursor.execute('''
+    return rows, delta, errors
+
+def save_cost_entries(conn, event_id, entries):
+    # insert a validated batch in one transaction, then recompute totals once
+    cursor = conn.cursor()
+    rows, delta, errors = prepare_cost_entries(cursor, event_id, entries)
+    if errors or not rows:
+        return 0, errors
+    cursor.executemany('''
         INSERT INTO cost_entries 
         (event_id, cost_type_id, cost_type_name, description, hours, rate_per_hour, amount, 
          volunteer_id, volunteer_name, volunteer_contact, is_income)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        event_id, cost_type_id, cost_type['name'] if cost_type else 'Other',
-        request.form.get('description'),
-        hours, rate, amount,
-        request.form.get('volunteer_id') or None,
-        request.form.get('volunteer_name'),
-        request.form.get('volunteer_contact'),
-        1 if request.form.get('is_income') == 'yes' else 0
-    ))
+    ''', rows)
+    refresh_event_totals(cursor, event_id)
     conn.commit()
+    publish_event_totals(cursor, event_id, **delta)
+    return len(rows), []
+
+@app.route('/events/<int:event_id>/costs/add', methods=['POST'])
+def add_cost_entry(event_id):
+    """Add cost entry"""
+    conn = get_db()
+    count, errors = save_cost_entries(conn, event_id, [request.form])
+    conn.close()
+    if errors:
+        flash(errors[0], 'error')
+    else:
+        flash('Cost entry added!', 'success')
+    return redirect(url_for('edit_event', event_id=event_id))
+
+@app.route('/events/<int:event_id>/costs/batch', methods=['POST'])
+def add_cost_entries_batch(event_id):
+    """Add timesheet rows (many cost entries) in one go"""
+    fields = ['cost_type_id', 'is_income', 'volunteer_id', 'hours', 'rate_per_hour', 'amount', 'description']
+    columns = {f: request.form.getlist(f) for f in fields}
+    entries = []
+    for i in range(len(columns['cost_type_id'])):
+        entry = {f: (columns[f][i] if i < len(columns[f]) else None) for f in fields}
+        # skip the spare blank rows of the timesheet
+        try:
+            blank = not float(entry['hours'] or 0) and not float(entry['amount'] or 0)
+        except ValueError:
+            blank = False  # prepare_cost_entries reports it
+        if blank:
+            continue
+        entries.append(entry)
+    
+    conn = get_db()
+    count, errors = save_cost_entries(conn, event_id, entries)
     conn.close()
-    flash('Cost entry added!', 'success')
+    if errors:
+        flash('Nothing saved - ' + '; '.join(errors), 'error')
+    elif count:
+        flash(f'{count} cost entries added!', 'success')
     return redirect(url_for('edit_event', event_id=event_id))
 
 @app.route('/costs/<int:cost_id>/delete', methods=['POST'])
@@ -345,11 +702,23 @@ def delete_cost_entry(cost_id):
     """Delete cost entry"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT event_id FROM cost_entries WHERE id = ?', (cost_id,))
+    cursor.execute('''
+        SELECT ce.*, ct.flags FROM cost_entries ce
+        LEFT JOIN cost_types ct ON ce.cost_type_id = ct.id
+        WHERE ce.id = ?
+    ''', (cost_id,))
     result = cursor.fetchone()
     event_id = result['event_id'] if result else None
     cursor.execute('DELETE FROM cost_entries WHERE id = ?', (cost_id,))
+    if result:
+        refresh_event_totals(cursor, event_id)
     conn.commit()
+    
+    if result:
+        amount = result['amount'] or 0
+        labor_value = (result['hours'] or 0) * (result['rate_per_hour'] or 0) if (result['flags'] or 0) & COST_FLAG_LABOR else 0
+        publish_event_totals(cursor, event_id, income=-amount if result['is_income'] else 0,
+                             expense=0 if result['is_income'] else -amount, labor_value=-labor_value)
     conn.close()
     flash('Cost entry deleted', 'success')
     return redirect(url_for('edit_event', event_id=event_id))
@@ -360,7 +729,19 @@ def add_distribution(event_id):
     conn = get_db()
     cursor = conn.cursor()
     
-    percentage = float(request.form.get('percentage') or 0)
+    try:
+        percentage = float(request.form.get('percentage') or 0)
+    except ValueError:
+        percentage = 0
+    
+    # distributions can't add up to more than the whole net profit
+    # (rounded, so 28.57 + 60.7 + 10.73 isn't off by float error)
+    allocated = allocated_percentage(cursor, event_id)
+    if not 0 < percentage < float('inf') or round(allocated + percentage, PERCENTAGE_PLACES) > MAX_PERCENTAGE:
+        conn.close()
+        remaining = max(0.0, round(MAX_PERCENTAGE - allocated, PERCENTAGE_PLACES))
+        flash(f'Percentage must be above 0 and at most {remaining:g}% ({round(allocated, PERCENTAGE_PLACES):g}% already distributed)', 'error')
+        return redirect(url_for('edit_event', event_id=event_id))
     
     # Get net profit
     cursor.execute('SELECT net_profit FROM event_profiles WHERE id = ?', (event_id,))
@@ -380,6 +761,7 @@ def add_distribution(event_id):
         request.form.get('notes')
     ))
     conn.commit()
+    publish_event_totals(cursor, event_id)
     conn.close()
     flash('Distribution added!', 'success')
     return redirect(url_for('edit_event', event_id=event_id))
@@ -394,6 +776,8 @@ def delete_distribution(dist_id):
     event_id = result['event_id'] if result else None
     cursor.execute('DELETE FROM profit_distributions WHERE id = ?', (dist_id,))
     conn.commit()
+    if event_id:
+        publish_event_totals(cursor, event_id)
     conn.close()
     flash('Distribution deleted', 'success')
     return redirect(url_for('edit_event', event_id=event_id))
@@ -418,15 +802,34 @@ def volunteer_list():
     """Volunteer list"""
     conn = get_db()
     cursor = conn.cursor()
+    if spans_shards():
+        # volunteers are common, their cost entries are spread over the shards
+        cursor.execute('SELECT * FROM volunteers ORDER BY name, id')
+        volunteers = [dict(v, total_hours=0, total_donations=0, total_value=0, event_count=0) for v in cursor.fetchall()]
+        conn.close()
+        parts = fan_out(lambda cursor, org: cursor.execute('''
+            SELECT volunteer_id as id,
+                   SUM(hours) as total_hours,
+                   SUM(CASE WHEN is_income = 1 THEN amount ELSE 0 END) as total_donations,
+                   SUM(hours * rate_per_hour) as total_value,
+                   COUNT(DISTINCT event_id) as event_count
+            FROM cost_entries WHERE volunteer_id IS NOT NULL
+            GROUP BY volunteer_id
+        ''').fetchall())
+        known = {v['id'] for v in volunteers}
+        totals = merge_rows(volunteers, [row for part in parts for row in part], 'id',
+                            ['total_hours', 'total_donations', 'total_value', 'event_count'])
+        return render_template('volunteers.html', volunteers=[v for v in totals if v['id'] in known])
     cursor.execute('''
         SELECT v.*, 
                COALESCE(SUM(ce.hours), 0) as total_hours,
                COALESCE(SUM(CASE WHEN ce.is_income = 1 THEN ce.amount ELSE 0 END), 0) as total_donations,
+               COALESCE(SUM(ce.hours * ce.rate_per_hour), 0) as total_value,
                COUNT(DISTINCT ce.event_id) as event_count
         FROM volunteers v
         LEFT JOIN cost_entries ce ON v.id = ce.volunteer_id
-        GROUP BY v.id
-        ORDER BY v.name
+        GROUP BY v.name, v.id
+        ORDER BY v.name, v.id
     ''')
     volunteers = cursor.fetchall()
     conn.close()
@@ -465,21 +868,31 @@ def view_volunteer(vol_id):
         flash('Volunteer not found', 'error')
         return redirect(url_for('volunteer_list'))
     
-    cursor.execute('''
-        SELECT ce.*, ep.event_name, ep.event_date
-        FROM cost_entries ce
-        JOIN event_profiles ep ON ce.event_id = ep.id
-        WHERE ce.volunteer_id = ?
-        ORDER BY ep.event_date DESC
-    ''', (vol_id,))
-    entries = cursor.fetchall()
+    def volunteer_entries(cursor, org=None):
+        cursor.execute('''
+            SELECT ce.*, ep.event_name, ep.event_date
+            FROM cost_entries ce
+            JOIN event_profiles ep ON ce.event_id = ep.id
+            WHERE ce.volunteer_id = ?
+            ORDER BY ep.event_date DESC
+        ''', (vol_id,))
+        entries = cursor.fetchall()
+        
+        cursor.execute('''
+            SELECT COALESCE(SUM(hours), 0) as total_hours,
+                   COALESCE(SUM(CASE WHEN is_income = 1 THEN amount ELSE 0 END), 0) as total_donations,
+                   COALESCE(SUM(hours * rate_per_hour), 0) as total_value
+            FROM cost_entries WHERE volunteer_id = ?
+        ''', (vol_id,))
+        return entries, cursor.fetchone()
     
-    cursor.execute('''
-        SELECT COALESCE(SUM(hours), 0) as total_hours,
-               COALESCE(SUM(CASE WHEN is_income = 1 THEN amount ELSE 0 END), 0) as total_donations
-        FROM cost_entries WHERE volunteer_id = ?
-    ''', (vol_id,))
-    totals = cursor.fetchone()
+    if spans_shards():
+        # their cost entries are spread over the organizations' shards
+        parts = fan_out(volunteer_entries)
+        entries = sorted((e for p in parts for e in p[0]), key=lambda e: e['event_date'] or '', reverse=True)
+        totals = {key: sum(p[1][key] for p in parts) for key in ('total_hours', 'total_donations', 'total_value')}
+    else:
+        entries, totals = volunteer_entries(cursor)
     
     conn.close()
     return render_template('view_volunteer.html', volunteer=volunteer, entries=entries, totals=totals)
@@ -487,9 +900,15 @@ def view_volunteer(vol_id):
 @app.route('/volunteers/<int:vol_id>/delete', methods=['POST'])
 def delete_volunteer(vol_id):
     """Delete volunteer"""
+    def unlink(cursor, org=None):
+        cursor.execute('UPDATE cost_entries SET volunteer_id = NULL WHERE volunteer_id = ?', (vol_id,))
+        cursor.connection.commit()
+    
+    if spans_shards():
+        fan_out(unlink)
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('UPDATE cost_entries SET volunteer_id = NULL WHERE volunteer_id = ?', (vol_id,))
+    unlink(cursor)
     cursor.execute('DELETE FROM volunteers WHERE id = ?', (vol_id,))
     conn.commit()
     conn.close()
@@ -502,8 +921,7 @@ def organization_list():
     """Organization list"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM organizations ORDER BY name')
-    organizations = cursor.fetchall()
+    organizations = reference_rows(cursor, 'organizations')
     conn.close()
     return render_template('organizations.html', organizations=organizations)
 
@@ -545,8 +963,7 @@ def event_type_list():
     """Event type list"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM event_types ORDER BY name')
-    event_types = cursor.fetchall()
+    event_types = reference_rows(cursor, 'event_types')
     conn.close()
     return render_template('event_types.html', event_types=event_types)
 
@@ -582,10 +999,14 @@ def cost_type_list():
     """Cost type list"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM cost_types ORDER BY name')
-    cost_types = cursor.fetchall()
+    cost_types = reference_rows(cursor, 'cost_types')
     conn.close()
-    return render_template('cost_types.html', cost_types=cost_types)
+    return render_template('cost_types.html', cost_types=cost_types, cost_flags=COST_FLAGS)
+
+def posted_flags():
+    # the checked flag bits OR'd together; repeats and unknown values are ignored
+    allowed = {flag for flag, _ in COST_FLAGS}
+    return functools.reduce(operator.or_, {f for f in request.form.getlist('flags', type=int) if f in allowed}, 0)
 
 @app.route('/cost-types/add', methods=['POST'])
 def add_cost_type():
@@ -593,8 +1014,9 @@ def add_cost_type():
     conn = get_db()
     cursor = conn.cursor()
     try:
-        cursor.execute('INSERT INTO cost_types (name, default_rate, description) VALUES (?, ?, ?)',
-                      (request.form['name'], request.form.get('default_rate') or 0, request.form.get('description')))
+        cursor.execute('INSERT INTO cost_types (name, default_rate, description, flags) VALUES (?, ?, ?, ?)',
+                      (request.form['name'], request.form.get('default_rate') or 0, request.form.get('description'),
+                       posted_flags()))
         conn.commit()
         flash('Cost type added successfully!', 'success')
     except:
@@ -602,6 +1024,17 @@ def add_cost_type():
     conn.close()
     return redirect(url_for('cost_type_list'))
 
+@app.route('/cost-types/<int:type_id>/flags', methods=['POST'])
+def update_cost_type_flags(type_id):
+    """Update cost type classification"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE cost_types SET flags = ? WHERE id = ?', (posted_flags(), type_id))
+    conn.commit()
+    conn.close()
+    flash('Cost type updated', 'success')
+    return redirect(url_for('cost_type_list'))
+
 @app.route('/cost-types/<int:type_id>/delete', methods=['POST'])
 def delete_cost_type(type_id):
     """Delete cost type"""
@@ -691,19 +1124,19 @@ def delete_lens_subcategory(subcat_id):
 @app.route('/lens-demo')
 def lens_demo():
     """LENS demo page"""
-    return render_template('lens_demo.html')
+    return serve_prerendered() or render_template('lens_demo.html')
 
 @app.route('/lens-application-list')
 def lens_application_list():
     """LENS application list page"""
-    return render_template('lens_application_list.html')
+    return serve_prerendered() or render_template('lens_application_list.html')
 
 @app.route('/community/<category>')
 @app.route('/community/<category>/<subcategory>')
 @app.route('/community/<category>/<subcategory>/<detail>')
 def community_menu(category, subcategory=None, detail=None):
     """Community engagement menu pages"""
-    return render_template('community_page.html', 
+    return serve_prerendered() or render_template('community_page.html', 
                          category=category, 
                          subcategory=subcategory, 
                          detail=detail)
@@ -715,10 +1148,8 @@ def reports():
     """Reports page"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT DISTINCT quarter FROM event_profiles WHERE quarter IS NOT NULL ORDER BY quarter DESC')
-    quarters = [row['quarter'] for row in cursor.fetchall()]
-    cursor.execute('SELECT DISTINCT year FROM event_profiles WHERE year IS NOT NULL ORDER BY year DESC')
-    years = [row['year'] for row in cursor.fetchall()]
+    quarters = event_quarters(cursor)
+    years = event_years(cursor)
     conn.close()
     return render_template('reports.html', quarters=quarters, years=years)
 
@@ -729,78 +1160,353 @@ def generate_report():
     quarter = request.form.get('quarter')
     year = request.form.get('year', type=int)
     
+    # quarter strings look like 2025Q3
+    quarter_match = re.fullmatch(r'(\d{4})Q([1-4])', quarter or '')
+    if (report_type == 'quarterly' and quarter and not quarter_match) or \
+            (report_type == 'annual' and year is not None and not 1 <= year <= 9999):
+        flash('Pick a quarter like 2025Q3 or a four-digit year', 'error')
+        return redirect(url_for('reports'))
+    
     conn = get_db()
     cursor = conn.cursor()
     
     if report_type == 'quarterly' and quarter:
-        where_clause = 'ep.quarter = ?'
-        params = [quarter]
+        q_year, q_num = quarter_match.groups()
+        period_range = get_date_range('quarterly', int(q_year), int(q_num))
         title = f"{quarter} Report"
     elif report_type == 'annual' and year:
-        where_clause = 'ep.year = ?'
-        params = [year]
+        period_range = get_date_range('annual', year)
         title = f"{year} Annual Report"
     else:
+        period_range = None
+        title = "All Time Report"
+    
+    if period_range:
+        schema = attach_for_period(conn, *period_range)
+        clauses, params = date_range_filter(*period_range)
+        where_clause = ' AND '.join(clauses)
+    else:
+        schema = ''
         where_clause = '1=1'
         params = []
-        title = "All Time Report"
     
-    # Get events
-    cursor.execute(f'''
+    def report_figures(cursor, org=None):
+        # Statistics
+        cursor.execute(f'SELECT COUNT(*) FROM {schema}event_profiles ep WHERE {where_clause}', params)
+        total_events = cursor.fetchone()[0]
+        
+        cursor.execute(f'''
+            SELECT COALESCE(SUM(ep.total_income), 0), COALESCE(SUM(ep.total_expense), 0), COALESCE(SUM(ep.net_profit), 0)
+            FROM {schema}event_profiles ep WHERE {where_clause}
+        ''', params)
+        totals = cursor.fetchone()
+        
+        cursor.execute(f'SELECT COALESCE(SUM(ep.actual_participants), 0) FROM {schema}event_profiles ep WHERE {where_clause}', params)
+        total_participants = cursor.fetchone()[0]
+        
+        # By type
+        cursor.execute(f'''
+            SELECT et.name, COUNT(*) as count, COALESCE(SUM(ep.actual_participants), 0) as participants,
+                   COALESCE(SUM(ep.net_profit), 0) as profit
+            FROM {schema}event_profiles ep
+            LEFT JOIN event_types et ON ep.event_type_id = et.id
+            WHERE {where_clause}
+            GROUP BY et.name
+        ''', params)
+        by_type = cursor.fetchall()
+        
+        # Cost breakdown (by type id, so renamed types stay together)
+        cursor.execute(f'''
+            SELECT ce.cost_type_id, COALESCE(ct.name, MAX(ce.cost_type_name)) as cost_type_name,
+                   SUM(ce.hours) as hours,
+                   SUM(CASE WHEN ce.is_income = 1 THEN ce.amount ELSE 0 END) as income,
+                   SUM(CASE WHEN ce.is_income = 0 THEN ce.amount ELSE 0 END) as expense
+            FROM {schema}cost_entries ce
+            JOIN {schema}event_profiles ep ON ce.event_id = ep.id
+            LEFT JOIN cost_types ct ON ce.cost_type_id = ct.id
+            WHERE {where_clause}
+            GROUP BY ce.cost_type_id
+        ''', params)
+        cost_breakdown = cursor.fetchall()
+        
+        return total_events, totals, total_participants, by_type, cost_breakdown
+    
+    events_sql = f'''
         SELECT ep.*, et.name as event_type_name
-        FROM event_profiles ep
-        LEFT JOIN event_types et ON ep.event_type_id = et.id
-        WHERE {where_clause}
-        ORDER BY ep.event_date
-    ''', params)
-    events = cursor.fetchall()
-    
-    # Statistics
-    cursor.execute(f'SELECT COUNT(*) FROM event_profiles ep WHERE {where_clause}', params)
-    total_events = cursor.fetchone()[0]
-    
-    cursor.execute(f'''
-        SELECT COALESCE(SUM(ep.total_income), 0), COALESCE(SUM(ep.total_expense), 0), COALESCE(SUM(ep.net_profit), 0)
-        FROM event_profiles ep WHERE {where_clause}
-    ''', params)
-    totals = cursor.fetchone()
-    
-    cursor.execute(f'SELECT COALESCE(SUM(ep.actual_participants), 0) FROM event_profiles ep WHERE {where_clause}', params)
-    total_participants = cursor.fetchone()[0]
-    
-    # By type
-    cursor.execute(f'''
-        SELECT et.name, COUNT(*) as count, COALESCE(SUM(ep.actual_participants), 0) as participants,
-               COALESCE(SUM(ep.net_profit), 0) as profit
-        FROM event_profiles ep
+        FROM {schema}event_profiles ep
         LEFT JOIN event_types et ON ep.event_type_id = et.id
         WHERE {where_clause}
-        GROUP BY et.name
-    ''', params)
-    by_type = cursor.fetchall()
+        ORDER BY ep.event_day
+    '''
     
-    # Cost breakdown
-    cursor.execute(f'''
-        SELECT ce.cost_type_name, SUM(ce.amount) as total, SUM(ce.hours) as total_hours
-        FROM cost_entries ce
-        JOIN event_profiles ep ON ce.event_id = ep.id
-        WHERE {where_clause} AND ce.is_income = 0
-        GROUP BY ce.cost_type_name
-    ''', params)
-    cost_breakdown = cursor.fetchall()
+    events = None
+    if not schema and spans_shards():
+        # each shard's figures added up, its events merged in date order
+        parts = fan_out(lambda cursor, org: report_figures(cursor) + (cursor.execute(events_sql, params).fetchall(),))
+        total_events = sum(p[0] for p in parts)
+        totals = tuple(sum(p[1][i] for p in parts) for i in range(3))
+        total_participants = sum(p[2] for p in parts)
+        by_type = merge_rows([row for p in parts for row in p[3]], [], 'name', ['count', 'participants', 'profit'])
+        cost_breakdown = merge_rows([row for p in parts for row in p[4]], [], 'cost_type_id', ['hours', 'income', 'expense'])
+        events = list(heapq.merge(*(p[5] for p in parts), key=event_day_key))
+    else:
+        total_events, totals, total_participants, by_type, cost_breakdown = report_figures(cursor)
     
-    conn.close()
+    # all-time reports add archived years from their summary rows
+    if not period_range:
+        archived = summary_totals(cursor)
+        total_events += archived['events']
+        total_participants += archived['participants']
+        totals = (totals[0] + archived['total_income'], totals[1] + archived['total_expense'],
+                  totals[2] + archived['net_profit'])
+        by_type = merge_rows(by_type, summary_by_type(cursor), 'name', ['count', 'participants', 'profit'])
+        cost_breakdown = merge_rows(cost_breakdown, summary_cost_breakdown(cursor), 'cost_type_id', ['hours', 'income', 'expense'])
     
-    return render_template('report_result.html',
+    if events is None:
+        # Events last - they're read while the page streams; RowStream closes conn
+        cursor.execute(events_sql, params)
+        events = RowStream(conn, cursor)
+    else:
+        conn.close()
+    
+    return render_page('report_result.html',
                          title=title, events=events,
                          total_events=total_events,
                          total_income=totals[0],
                          total_expense=totals[1],
                          net_profit=totals[2],
                          total_participants=total_participants,
+                         total_hours=sum(c['hours'] or 0 for c in cost_breakdown),
                          by_type=by_type,
                          cost_breakdown=cost_breakdown)
 
+
+# ========== JSON API ==========
+@app.route('/api/events/<int:event_id>/costs', methods=['POST'])
+def api_add_cost_entries(event_id):
+    """Add many cost entries: {"entries": [{cost_type_id, hours, rate_per_hour, amount, ...}]}"""
+    data = request.get_json(silent=True) or {}
+    entries = data.get('entries')
+    if not isinstance(entries, list) or not entries or not all(isinstance(e, dict) for e in entries):
+        return jsonify({'errors': ['Expected {"entries": [...]} with at least one entry']}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id FROM event_profiles WHERE id = ?', (event_id,))
+    if not cursor.fetchone():
+        conn.close()
+        return jsonify({'errors': ['Event not found']}), 404
+    
+    count, errors = save_cost_entries(conn, event_id, entries)
+    if errors:
+        conn.close()
+        return jsonify({'errors': errors}), 400
+    cursor.execute('SELECT total_income, total_expense, net_profit FROM event_profiles WHERE id = ?', (event_id,))
+    totals = dict(cursor.fetchone())
+    conn.close()
+    return jsonify({'inserted': count, **totals}), 201
+
+
+# ========== Live updates ==========
+@app.route('/stream')
+def stream():
+    """Server-Sent Events feed of event total/KPI changes.
+    
+    ?event_id= limits it to one event (edit page); otherwise the dashboard
+    filters (period, year, quarter, org_id) decide which events count.
+    The Last-Event-ID header (or ?last_event_id=) replays what was missed.
+    """
+    event_id = request.args.get('event_id', type=int)
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    if last_event_id is None:
+        last_event_id = request.args.get('last_event_id', type=int)
+    lifetime = app.config['LIVE_STREAM_SECONDS']
+    org_id = request.args.get('org_id', type=int)
+    try:
+        start_date, end_date = request_date_range()
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/plain')
+    first_day = date_key(start_date) if start_date else 0
+    last_day = date_key(end_date)
+    
+    def wanted(msg):
+        if event_id:
+            return msg['event_id'] == event_id
+        if org_id and msg['organization_id'] != org_id:
+            return False
+        return msg['event_day'] is not None and first_day <= msg['event_day'] <= last_day
+    
+    def generate():
+        q = subscribe()
+        ends = time.monotonic() + lifetime
+        try:
+            yield 'retry: 5000\n\n'
+            # subscribed first, so nothing falls between the replay and the queue
+            missed = []
+            if last_event_id is not None:
+                conn = get_db()
+                missed = messages_since(conn.cursor(), last_event_id)
+                conn.close()
+            sent = last_event_id or 0
+            while time.monotonic() < ends:
+                if missed:
+                    seq, msg = missed.pop(0)
+                else:
+                    try:
+                        seq, msg = q.get(timeout=max(0.1, min(15, ends - time.monotonic())))
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                if seq <= sent:
+                    continue
+                sent = seq
+                if wanted(msg):
+                    yield f'id: {seq}\ndata: {json.dumps(msg)}\n\n'
+        finally:
+            unsubscribe(q)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# ========== Events API ==========
+def events_response(ids, fields, include):
+    try:
+        if spans_shards():
+            # each shard fetches its own share of the ids, in parallel
+            groups = shard_groups('event_profiles', ids) or {None: []}
+            parts = fan_out(lambda cursor, org: fetch_events(cursor, groups[org], fields, include)[0], list(groups))
+            found = {e['id']: e for part in parts for e in part}
+            events, missing = [found[i] for i in ids if i in found], [i for i in ids if i not in found]
+        else:
+            conn = get_db()
+            try:
+                events, missing = fetch_events(conn.cursor(), ids, fields, include)
+            finally:
+                conn.close()
+    except ValueError as e:
+        return jsonify({'errors': [str(e)]}), 400
+    return jsonify({'events': events, 'missing': missing})
+
+@app.route('/api/events')
+def api_events():
+    """Many events in one call: ?ids=1,2,3 or a filtered page (org_id, period, limit, offset)"""
+    fields = parse_list(request.args.get('fields'))
+    include = parse_list(request.args.get('include'))
+    if request.args.get('ids'):
+        try:
+            ids = parse_ids(request.args['ids'])
+        except ValueError as e:
+            return jsonify({'errors': [str(e)]}), 400
+        return events_response(ids, fields, include)
+    
+    # no ids - newest events matching the dashboard-style filters
+    try:
+        start_date, end_date = request_date_range()
+    except ValueError as e:
+        return jsonify({'errors': [str(e)]}), 400
+    where_clauses, params = date_range_filter(start_date, end_date)
+    org_id = request.args.get('org_id', type=int)
+    if org_id:
+        where_clauses.append('ep.organization_id = ?')
+        params.append(org_id)
+    limit = max(1, min(request.args.get('limit', 100, type=int), MAX_EVENT_IDS))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    page_sql = f'''
+        SELECT ep.id, ep.event_day FROM event_profiles ep WHERE {' AND '.join(where_clauses)}
+        ORDER BY ep.event_day DESC, ep.id DESC LIMIT ? OFFSET ?
+    '''
+    if spans_shards():
+        # the page may come from any shard: take each one's first offset + limit rows
+        parts = fan_out(lambda cursor, org: cursor.execute(page_sql, params + [offset + limit, 0]).fetchall())
+        rows = list(heapq.merge(*parts, key=lambda row: (event_day_key(row), row['id']), reverse=True))
+        ids = [row['id'] for row in rows[offset:offset + limit]]
+    else:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute(page_sql, params + [limit, offset])
+        ids = [row['id'] for row in cursor.fetchall()]
+        conn.close()
+    return events_response(ids, fields, include)
+
+@app.route('/api/events/fetch', methods=['POST'])
+def api_events_fetch():
+    """Many events in one call: {"ids": [...], "fields": [...], "include": [...]}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        ids = parse_ids(data.get('ids'))
+        fields, include = parse_list(data.get('fields')), parse_list(data.get('include'))
+    except ValueError as e:
+        return jsonify({'errors': [str(e)]}), 400
+    return events_response(ids, fields, include)
+
+@app.route('/api/events/bulk', methods=['POST'])
+def api_events_bulk():
+    """Change many events in one transaction (one per shard): {"ids": [...], "action": "status"|"delete", "status": ...}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        ids = parse_ids(data.get('ids'))
+    except ValueError as e:
+        return jsonify({'errors': [str(e)]}), 400
+    action = data.get('action')
+    if action not in ('status', 'delete'):
+        return jsonify({'errors': ['action must be "status" or "delete"']}), 400
+    
+    def apply(cursor, ids):
+        if action == 'status':
+            changed = bulk_set_status(cursor, ids, data.get('status'))
+        else:
+            changed = bulk_delete(cursor, ids)
+        cursor.connection.commit()
+        return changed
+    
+    try:
+        if spans_shards():
+            groups = shard_groups('event_profiles', ids) or {None: []}
+            changed = sum(fan_out(lambda cursor, org: apply(cursor, groups[org]), list(groups)))
+        else:
+            conn = get_db()
+            try:
+                changed = apply(conn.cursor(), ids)
+            finally:
+                # closing without a commit rolls back
+                conn.close()
+    except ValueError as e:
+        return jsonify({'errors': [str(e)]}), 400
+    return jsonify({'updated' if action == 'status' else 'deleted': changed})
+
+
+# ========== Query budget metrics ==========
+@app.route('/api/query-budget')
+def api_query_budget():
+    """Budgeted and aborted requests per endpoint"""
+    return jsonify({'seconds': app.config['QUERY_BUDGET_SECONDS'],
+                    'steps': app.config['QUERY_BUDGET_STEPS'],
+                    'endpoints': budget_metrics})
+
+
+# ========== Sync API ==========
+@app.route('/api/changes')
+def api_changes():
+    """Change feed - changes after ?since=<seq>, in batches of ?limit="""
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', DEFAULT_BATCH, type=int)
+    conn = get_db()
+    result = fetch_changes(conn.cursor(), since, limit)
+    conn.close()
+    if spans_shards():
+        # events, cost entries and distributions are logged in each organization's shard
+        result['sharded'] = True
+        result['shards'] = shard_orgs()
+        result['warning'] = ('Event, cost entry and distribution changes are not in this feed; '
+                             'sync each organization with /api/changes?org_id=<id>')
+    return jsonify(result)
+
+def init_worker():
+    """Reset per-process state in a freshly forked worker (gunicorn post_fork)"""
+    reset_reference_cache()
+    app.jinja_env.fragment_cache.clear()
+
 if __name__ == '__main__':
     init_db()
-    app.run(debug=True, port=5000)
+    app.run(debug=not PRODUCTION, port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,247 @@
+"""Cold storage for closed fiscal years.
+
+Closed years of event_profiles, cost_entries and profit_distributions are
+moved into one SQLite file per year (archive/community_<year>.db). Summary
+rows stay behind in the hot database so all-time numbers don't need the
+archived detail, and a year's file is only ATTACHed when a dashboard or
+report period asks for that year.
+
+Usage:
+    python archive.py 2023          # archive one closed year
+    python archive.py --list        # show archived years
+"""
+import argparse
+import os
+import re
+from datetime import date
+
+from database import get_db, init_db, ARCHIVE_DIR, COST_FLAG_LABOR, SHARDS_DIR
+
+ARCHIVED_TABLES = ['event_profiles', 'cost_entries', 'profit_distributions']
+
+
+def archive_path(year):
+    return os.path.join(ARCHIVE_DIR, f'community_{year}.db')
+
+
+def archive_file_years():
+    """Years that have an archive file"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    matches = (re.fullmatch(r'community_(\d+)\.db', name) for name in os.listdir(ARCHIVE_DIR))
+    return sorted(int(m.group(1)) for m in matches if m)
+
+
+def archived_years(cursor):
+    """Set of years that live in cold storage"""
+    cursor.execute('SELECT year FROM archived_years')
+    return {row[0] for row in cursor.fetchall()}
+
+
+def archive_year(year):
+    """Move one closed year out of the hot database into its own file.
+
+    A commit spanning attached databases isn't atomic in WAL mode, so the
+    copy is committed to the archive file first, and the hot database is
+    changed in a second transaction that only deletes rows found unchanged
+    in the archive.
+    """
+    if year >= date.today().year:
+        raise ValueError(f'{year} is not closed yet, only past years can be archived')
+    if SHARDS_DIR:
+        raise ValueError('Events are split into per-organization shards; archive closed years before splitting')
+
+    path = archive_path(year)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    first_day, last_day = year * 10000 + 101, year * 10000 + 1231
+
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('ATTACH DATABASE ? AS archive', (path,))
+
+    sync_archive_schema(cursor)
+    cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_event_profiles_day_org ON event_profiles (event_day, organization_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_cost_entries_event ON cost_entries (event_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_profit_distributions_event ON profit_distributions (event_id)')
+
+    # copy the year's rows (re-running picks up entries added after archiving)
+    # by column name - an archive made before a migration has its columns in another order
+    year_events = 'SELECT id FROM main.event_profiles WHERE event_day BETWEEN ? AND ?'
+    year_rows = {'event_profiles': 'event_day BETWEEN ? AND ?',
+                 'cost_entries': f'event_id IN ({year_events})',
+                 'profit_distributions': f'event_id IN ({year_events})'}
+    names = {table: ', '.join(columns(cursor, 'main', table)) for table in ARCHIVED_TABLES}
+    moved = 0
+    for table in ARCHIVED_TABLES:
+        cursor.execute(f'INSERT OR REPLACE INTO archive.{table} ({names[table]}) '
+                       f'SELECT {names[table]} FROM main.{table} WHERE {year_rows[table]}', (first_day, last_day))
+        if table == 'event_profiles':
+            moved = cursor.rowcount
+    conn.commit()
+
+    # from here on only the hot database is written; holding its write lock,
+    # check every row about to go has an identical archived copy
+    cursor.execute('BEGIN IMMEDIATE')
+    for table in ARCHIVED_TABLES:
+        cursor.execute(f'SELECT COUNT(*) FROM (SELECT {names[table]} FROM main.{table} WHERE {year_rows[table]} '
+                       f'EXCEPT SELECT {names[table]} FROM archive.{table})', (first_day, last_day))
+        missing = cursor.fetchone()[0]
+        if missing:
+            conn.rollback()
+            cursor.execute('DETACH DATABASE archive')
+            conn.close()
+            raise ValueError(f'{missing} {table} rows for {year} changed while archiving; run it again')
+
+    # rebuild the year's summary rows from the archived detail
+    cursor.execute('DELETE FROM archive_summaries WHERE year = ?', (year,))
+    cursor.execute('DELETE FROM archive_cost_summaries WHERE year = ?', (year,))
+    cursor.execute('''
+        INSERT INTO archive_summaries
+        (year, quarter, organization_id, event_type_id, event_count, participants,
+         total_income, total_expense, net_profit)
+        SELECT ?, quarter, organization_id, event_type_id, COUNT(*), COALESCE(SUM(actual_participants), 0),
+               COALESCE(SUM(total_income), 0), COALESCE(SUM(total_expense), 0), COALESCE(SUM(net_profit), 0)
+        FROM archive.event_profiles
+        GROUP BY quarter, organization_id, event_type_id
+    ''', (year,))
+    cursor.execute('''
+        INSERT INTO archive_cost_summaries
+        (year, quarter, organization_id, cost_type_id, cost_type_name, is_income, total, total_hours, hours_value)
+        SELECT ?, ep.quarter, ep.organization_id, ce.cost_type_id, ce.cost_type_name, ce.is_income,
+               COALESCE(SUM(ce.amount), 0), COALESCE(SUM(ce.hours), 0), COALESCE(SUM(ce.hours * ce.rate_per_hour), 0)
+        FROM archive.cost_entries ce
+        JOIN archive.event_profiles ep ON ce.event_id = ep.id
+        GROUP BY ep.quarter, ep.organization_id, ce.cost_type_id, ce.cost_type_name, ce.is_income
+    ''', (year,))
+
+    # drop the detail from the hot database; the change feed reports these
+    # rows as archived rather than deleted
+    cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log')
+    last_seq = cursor.fetchone()[0]
+    for table in ('cost_entries', 'profit_distributions'):
+        cursor.execute(f'DELETE FROM main.{table} WHERE event_id IN ({year_events})', (first_day, last_day))
+    cursor.execute('DELETE FROM main.event_profiles WHERE event_day BETWEEN ? AND ?', (first_day, last_day))
+    cursor.execute("UPDATE change_log SET op = 'archive' WHERE seq > ? AND op = 'delete'", (last_seq,))
+    cursor.execute('INSERT OR REPLACE INTO archived_years (year, path) VALUES (?, ?)', (year, path))
+
+    conn.commit()
+    cursor.execute('DETACH DATABASE archive')
+    conn.close()
+    return moved
+
+
+def columns(cursor, schema, table):
+    cursor.execute(f'PRAGMA {schema}.table_info({table})')
+    return [row['name'] for row in cursor.fetchall()]
+
+
+def sync_archive_schema(cursor):
+    """Create the archive's tables from the hot database's definitions, or add
+    the columns added to the hot tables since the archive file was made"""
+    for table in ARCHIVED_TABLES:
+        cursor.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        create_sql = cursor.fetchone()[0]
+        cursor.execute(create_sql.replace(f'CREATE TABLE {table}', f'CREATE TABLE IF NOT EXISTS archive.{table}', 1))
+        archived = set(columns(cursor, 'archive', table))
+        cursor.execute(f'PRAGMA main.table_info({table})')
+        for column in cursor.fetchall():
+            if column['name'] not in archived:
+                decl = column['type'] + (f" DEFAULT {column['dflt_value']}" if column['dflt_value'] is not None else '')
+                cursor.execute(f"ALTER TABLE archive.{table} ADD COLUMN {column['name']} {decl}")
+
+
+def attach_for_period(conn, start, end):
+    """Attach the archive holding [start, end] if that year is archived.
+
+    Returns the schema prefix to query event tables with: '' for the hot
+    database, 'archive.' when the period lives in cold storage.
+    """
+    if start is None or start.year != end.year:
+        return ''
+    cursor = conn.cursor()
+    if start.year not in archived_years(cursor):
+        return ''
+    cursor.execute('ATTACH DATABASE ? AS archive', (archive_path(start.year),))
+    return 'archive.'
+
+
+def summary_totals(cursor, org_id=None):
+    """All-time totals for archived years, read from the summary rows"""
+    org_sql = ' WHERE organization_id = ?' if org_id else ''
+    params = [org_id] if org_id else []
+
+    cursor.execute(f'''
+        SELECT COALESCE(SUM(event_count), 0) as events, COALESCE(SUM(participants), 0) as participants,
+               COALESCE(SUM(total_income), 0) as total_income, COALESCE(SUM(total_expense), 0) as total_expense,
+               COALESCE(SUM(net_profit), 0) as net_profit
+        FROM archive_summaries{org_sql}
+    ''', params)
+    totals = dict(cursor.fetchone())
+
+    cursor.execute(f'''
+        SELECT COALESCE(SUM(CASE WHEN is_income = 1 THEN total END), 0) as income,
+               COALESCE(SUM(CASE WHEN is_income = 0 THEN total END), 0) as expense,
+               COALESCE(SUM(CASE WHEN cost_type_id IN (SELECT id FROM cost_types WHERE flags & ?)
+                            THEN hours_value END), 0) as labor_value
+        FROM archive_cost_summaries{org_sql}
+    ''', [COST_FLAG_LABOR] + params)
+    totals.update(dict(cursor.fetchone()))
+    return totals
+
+
+def summary_by_type(cursor):
+    """Archived event counts/profit grouped by event type name"""
+    cursor.execute('''
+        SELECT et.name, SUM(s.event_count) as count, SUM(s.participants) as participants,
+               SUM(s.net_profit) as profit
+        FROM archive_summaries s
+        LEFT JOIN event_types et ON s.event_type_id = et.id
+        GROUP BY et.name
+    ''')
+    return cursor.fetchall()
+
+
+def summary_cost_breakdown(cursor):
+    """Archived hours/income/expense grouped by cost type"""
+    cursor.execute('''
+        SELECT s.cost_type_id, COALESCE(ct.name, MAX(s.cost_type_name)) as cost_type_name,
+               SUM(s.total_hours) as hours,
+               SUM(CASE WHEN s.is_income = 1 THEN s.total ELSE 0 END) as income,
+               SUM(CASE WHEN s.is_income = 0 THEN s.total ELSE 0 END) as expense
+        FROM archive_cost_summaries s
+        LEFT JOIN cost_types ct ON s.cost_type_id = ct.id
+        GROUP BY s.cost_type_id
+    ''')
+    return cursor.fetchall()
+
+
+def merge_rows(hot_rows, archived_rows, key, fields):
+    """Add archived summary rows onto hot rows that share the same key"""
+    merged = {}
+    for row in list(hot_rows) + list(archived_rows):
+        item = merged.setdefault(row[key], {**dict(row), **{f: 0 for f in fields}})
+        for f in fields:
+            item[f] += row[f] or 0
+    return list(merged.values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move closed years into cold storage')
+    parser.add_argument('year', type=int, nargs='?', help='year to archive')
+    parser.add_argument('--list', action='store_true', help='list archived years')
+    parser.add_argument('--no-vacuum', action='store_true', help="don't shrink community.db afterwards")
+    args = parser.parse_args()
+
+    init_db()
+    if args.list or not args.year:
+        conn = get_db()
+        for row in conn.execute('SELECT * FROM archived_years ORDER BY year'):
+            print(f"{row['year']}  {row['path']}  (archived {row['archived_at']})")
+        conn.close()
+    else:
+        moved = archive_year(args.year)
+        if not args.no_vacuum:
+            conn = get_db()
+            conn.execute('VACUUM')
+            conn.close()
+        print(f"Archived {moved} events from {args.year} to {archive_path(args.year)}")
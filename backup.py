@@ -0,0 +1,209 @@
+"""Online backups of community.db.
+
+Uses the SQLite backup API a few pages at a time with a short sleep
+between steps, so the app keeps serving reads and writes while a backup
+runs. Each copy is integrity-checked before it is kept, optionally
+gzipped, and old copies are rotated out.
+
+Usage:
+    python backup.py create [--compress] [--keep 7] [--pages 256] [--pause 0.05]
+    python backup.py verify backups/community-20250101-120000.db.gz
+    python backup.py list
+
+Set BACKUP_INTERVAL_HOURS to have app.py run backups in the background.
+
+Every closed year's archive file (see archive.py), and with SHARDS_DIR set
+every organization's shard (see shards.py), is copied in the same run,
+next to the common copy as community-<stamp>.year_<year>.db and
+community-<stamp>.org_<id>.db. The set is verified, listed and rotated
+together.
+"""
+import argparse
+import glob
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from archive import archive_file_years, archive_path
+from database import DATABASE, BACKUP_DIR
+from shards import shard_orgs, shard_path
+
+BACKUP_PREFIX = 'community-'
+SHARD_INFIX = '.org_'
+ARCHIVE_INFIX = '.year_'
+
+
+def backup_files(dest=BACKUP_DIR):
+    """Existing backups (common database copies), newest first"""
+    files = glob.glob(os.path.join(dest, BACKUP_PREFIX + '*.db')) + \
+        glob.glob(os.path.join(dest, BACKUP_PREFIX + '*.db.gz'))
+    files = [f for f in files if not any(infix in os.path.basename(f) for infix in (SHARD_INFIX, ARCHIVE_INFIX))]
+    return sorted(files, key=os.path.getmtime, reverse=True)
+
+
+def set_copies(path, infix):
+    """Shard (SHARD_INFIX) or archive (ARCHIVE_INFIX) backups taken in the
+    same run as the common backup at path"""
+    base = path[:path.rindex('.db')]
+    return sorted(glob.glob(glob.escape(base + infix) + '*.db') +
+                  glob.glob(glob.escape(base + infix) + '*.db.gz'))
+
+
+def backup_set(path):
+    """The common backup at path and every copy taken with it"""
+    return [path] + set_copies(path, ARCHIVE_INFIX) + set_copies(path, SHARD_INFIX)
+
+
+def verify_backup(path):
+    """Run PRAGMA integrity_check on a backup (plain or gzipped)"""
+    check_path = path
+    if path.endswith('.gz'):
+        fd, check_path = tempfile.mkstemp(suffix='.db')
+        with os.fdopen(fd, 'wb') as out, gzip.open(path, 'rb') as src:
+            shutil.copyfileobj(src, out)
+    try:
+        conn = sqlite3.connect(check_path)
+        try:
+            result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        except sqlite3.DatabaseError:
+            # not a database at all
+            result = None
+        conn.close()
+    finally:
+        if check_path != path:
+            os.remove(check_path)
+    return result == 'ok'
+
+
+def backup_database(dest=BACKUP_DIR, pages=256, pause=0.05, compress=False, keep=7, verify=True):
+    """Take an online backup of DATABASE, every archive file and every shard;
+    returns the common backup's path.
+
+    pages is how many pages are copied per step and pause is the sleep
+    between steps; the source is only locked for the duration of a step.
+    Each file is a consistent copy on its own, taken one after the other.
+    """
+    os.makedirs(dest, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(dest, f'{BACKUP_PREFIX}{stamp}.db')
+    # archives and shards first: the common copy appearing is what marks the set complete
+    copies = [(archive_path(year), os.path.join(dest, f'{BACKUP_PREFIX}{stamp}{ARCHIVE_INFIX}{year}.db'))
+              for year in archive_file_years()]
+    copies += [(shard_path(org_id), os.path.join(dest, f'{BACKUP_PREFIX}{stamp}{SHARD_INFIX}{org_id}.db'))
+               for org_id in shard_orgs()]
+    copies.append((DATABASE, path))
+    written = []
+    try:
+        for source, target in copies:
+            written.append(backup_file(source, target, pages, pause, compress, verify))
+    except Exception:
+        # no half sets - drop what this run already wrote
+        for done in written:
+            os.remove(done)
+        raise
+
+    # rotation - keep the newest N backups, each with its archive and shard copies
+    if keep:
+        for old in backup_files(dest)[keep:]:
+            for copy in reversed(backup_set(old)):
+                os.remove(copy)
+    return written[-1]
+
+
+def backup_file(source_path, path, pages, pause, compress, verify):
+    # one online, verified copy of source_path at path (+ .gz); returns the path written
+    partial = path + '.partial'
+
+    def throttle(status, remaining, total):
+        time.sleep(pause)
+
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(partial)
+    try:
+        source.backup(target, pages=pages, progress=throttle if pause else None)
+    finally:
+        target.close()
+        source.close()
+
+    if verify and not verify_backup(partial):
+        os.remove(partial)
+        raise RuntimeError(f'Backup {path} failed integrity check')
+
+    if compress:
+        with open(partial, 'rb') as src, gzip.open(path + '.gz', 'wb') as out:
+            shutil.copyfileobj(src, out)
+        os.remove(partial)
+        path += '.gz'
+    else:
+        os.replace(partial, path)
+    return path
+
+
+def start_scheduler(interval_hours, **options):
+    """Run backup_database every interval_hours in a daemon thread.
+
+    The age of the newest backup decides when the next one is due, so
+    several workers sharing BACKUP_DIR don't each take their own copy.
+    """
+    interval = interval_hours * 3600
+    dest = options.get('dest', BACKUP_DIR)
+
+    def run():
+        while True:
+            existing = backup_files(dest)
+            if not existing or time.time() - os.path.getmtime(existing[0]) >= interval:
+                try:
+                    print(f"Backup written to {backup_database(**options)}")
+                except Exception as e:
+                    print(f"Scheduled backup failed: {e}")
+            time.sleep(min(interval, 60))
+
+    thread = threading.Thread(target=run, name='backup-scheduler', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online backups of the community database')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    create = sub.add_parser('create', help='take a backup now')
+    create.add_argument('--dest', default=BACKUP_DIR)
+    create.add_argument('--pages', type=int, default=256, help='pages copied per step')
+    create.add_argument('--pause', type=float, default=0.05, help='seconds to sleep between steps')
+    create.add_argument('--compress', action='store_true', help='gzip the backup')
+    create.add_argument('--keep', type=int, default=7, help='number of backups to keep (0 = all)')
+    create.add_argument('--no-verify', action='store_true', help='skip the integrity check')
+
+    verify = sub.add_parser('verify', help='integrity-check a backup (and the copies taken with it)')
+    verify.add_argument('path')
+
+    list_cmd = sub.add_parser('list', help='list existing backups')
+    list_cmd.add_argument('--dest', default=BACKUP_DIR)
+
+    args = parser.parse_args()
+    if args.command == 'create':
+        start = time.time()
+        path = backup_database(args.dest, args.pages, args.pause, args.compress, args.keep, not args.no_verify)
+        print(f"Backup written to {path} in {time.time() - start:.1f}s")
+    elif args.command == 'verify':
+        failed = [f for f in backup_set(args.path) if not verify_backup(f)]
+        for f in failed:
+            print(f"FAILED {f}")
+        print('FAILED' if failed else 'ok')
+        raise SystemExit(1 if failed else 0)
+    else:
+        for path in backup_files(args.dest):
+            years, shards = set_copies(path, ARCHIVE_INFIX), set_copies(path, SHARD_INFIX)
+            size = sum(os.path.getsize(f) for f in backup_set(path))
+            extra = []
+            if years:
+                extra.append(f"{len(years)} archived years")
+            if shards:
+                extra.append(f"{len(shards)} shards")
+            print(f"{path}  {size} bytes" + (f"  (+ {', '.join(extra)})" if extra else ''))
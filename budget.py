@@ -0,0 +1,155 @@
+"""Per-request query budgets.
+
+Every connection opened by get_db() during a request gets a SQLite
+progress handler. Once the request has used up its budget (wall-clock
+seconds, not counting time a streamed page spends waiting on the client,
+and/or VM steps) the running statement is interrupted, so a
+runaway report gives its worker back instead of holding it until done.
+The route's error becomes a flash message (or a JSON error for /api/
+routes) and the abort is counted in budget.metrics (see /api/query-budget).
+
+Budgets are per endpoint, configured on the app:
+
+    QUERY_BUDGET_SECONDS   default seconds per request (0 = no time limit)
+    QUERY_BUDGET_STEPS     default VM steps per request (0 = no step limit)
+    QUERY_BUDGETS          {endpoint: {'seconds': ..., 'steps': ...}} overrides;
+                           None turns the budget off for that endpoint
+"""
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import flash, g, has_app_context, jsonify, redirect, render_template, request
+
+import database
+
+# VM instructions between progress handler calls
+CHECK_EVERY = 1000
+
+MESSAGE = 'This took too long and was stopped. Try a shorter period or a single organization.'
+
+# per endpoint: budgeted requests, aborted requests, time of the last abort
+metrics = {}
+_metrics_lock = threading.Lock()
+
+
+class QueryBudget:
+    """Deadline and VM step allowance for one request"""
+    def __init__(self, endpoint, seconds=None, steps=None):
+        self.endpoint = endpoint
+        self.started = time.monotonic()
+        self.deadline = self.started + seconds if seconds else None
+        self.steps = steps
+        self.used = 0
+        self.exceeded = False
+        self.paused_at = None
+        self.waited = 0
+
+    def pause(self):
+        self.paused_at = time.monotonic()
+
+    def resume(self):
+        # paused time doesn't count against the deadline
+        if self.paused_at is not None:
+            waited = time.monotonic() - self.paused_at
+            self.waited += waited
+            if self.deadline is not None:
+                self.deadline += waited
+            self.paused_at = None
+
+    def elapsed(self):
+        return time.monotonic() - self.started - self.waited
+
+    def check(self):
+        # progress handler - a non-zero return interrupts the statement
+        self.used += CHECK_EVERY
+        if not self.exceeded:
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                self.exceeded = True
+            elif self.steps and self.used > self.steps:
+                self.exceeded = True
+            if self.exceeded:
+                record(self.endpoint, 'aborted')
+        return 1 if self.exceeded else 0
+
+
+def record(endpoint, key):
+    with _metrics_lock:
+        entry = metrics.setdefault(endpoint, {'requests': 0, 'aborted': 0, 'last_abort': None})
+        entry[key] += 1
+        if key == 'aborted':
+            entry['last_abort'] = time.time()
+
+
+def current():
+    """Budget of the running request, if it has one"""
+    return g.get('query_budget') if has_app_context() else None
+
+
+def exceeded():
+    budget = current()
+    return budget is not None and budget.exceeded
+
+
+@contextmanager
+def paused():
+    """Stop the request's clock - e.g. while a streamed page waits on a slow client"""
+    budget = current()
+    if budget is not None:
+        budget.pause()
+    try:
+        yield
+    finally:
+        if budget is not None:
+            budget.resume()
+
+
+def install(conn, budget=None):
+    # database.get_db() calls this for every new connection; threads without
+    # a request context (shards.fan_out) pass the request's budget in
+    budget = budget or current()
+    if budget is not None:
+        conn.set_progress_handler(budget.check, CHECK_EVERY)
+
+
+def limits_for(config, endpoint):
+    """(seconds, steps) allowed for an endpoint, or None if unlimited"""
+    overrides = config.get('QUERY_BUDGETS', {})
+    if endpoint in overrides and overrides[endpoint] is None:
+        return None
+    limits = overrides.get(endpoint) or {}
+    seconds = limits.get('seconds', config.get('QUERY_BUDGET_SECONDS'))
+    steps = limits.get('steps', config.get('QUERY_BUDGET_STEPS'))
+    if not seconds and not steps:
+        return None
+    return seconds, steps
+
+
+def init_budget(app):
+    """Give every request a query budget and turn aborts into friendly errors"""
+    database.ON_CONNECT = install
+
+    @app.before_request
+    def start_budget():
+        # unmatched URLs (404s) have no endpoint to budget or count
+        if request.endpoint is None:
+            return
+        limits = limits_for(app.config, request.endpoint)
+        if limits:
+            g.query_budget = QueryBudget(request.endpoint, *limits)
+            record(request.endpoint, 'requests')
+
+    @app.errorhandler(sqlite3.OperationalError)
+    def budget_exceeded(e):
+        if not exceeded():
+            raise e
+        budget = current()
+        app.logger.warning('Query budget exceeded on %s after %.1fs / %d steps',
+                           request.path, budget.elapsed(), budget.used)
+        if request.path.startswith('/api/'):
+            return jsonify({'error': MESSAGE}), 503
+        flash(MESSAGE, 'error')
+        if request.referrer and request.referrer != request.url:
+            return redirect(request.referrer)
+        return render_template('base.html'), 503
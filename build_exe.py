@@ -1,32 +1,50 @@
 import PyInstaller.__main__
+import argparse
 import os
 import shutil
 
+# one folder by default: a --onefile exe unpacks its whole bundle to a temp
+# directory on every launch before Python even starts
+parser = argparse.ArgumentParser(description='Build the desktop executable')
+parser.add_argument('--onefile', action='store_true', help='single exe (slower to start)')
+args = parser.parse_args()
+
 # clean up old builds
 if os.path.exists('dist'):
     shutil.rmtree('dist')
 if os.path.exists('build'):
     shutil.rmtree('build')
 
+# pre-render the static pages so the exe serves them without Jinja
+from app import app
+from prerender import build as prerender_pages
+prerender_pages(app)
+
 # build the exe
 PyInstaller.__main__.run([
     'launcher.py',
     '--name=CommunitySystem',
-    '--onefile',
+    '--onefile' if args.onefile else '--onedir',
     '--windowed',
     '--add-data=templates;templates',
+    '--add-data=static_pages;static_pages',
     '--add-data=database.py;.',
     '--add-data=app.py;.',
     '--hidden-import=flask',
     '--hidden-import=sqlite3',
-    '--hidden-import=dateutil',
     '--hidden-import=webbrowser',
     '--hidden-import=threading',
+    '--exclude-module=tkinter',
+    '--noupx',
     '--icon=NONE',
     '--clean',
 ])
 
 print("\n" + "="*50)
 print("Build complete!")
-print("Executable location: dist/CommunitySystem.exe")
+if args.onefile:
+    print("Executable location: dist/CommunitySystem.exe")
+else:
+    print("Executable location: dist/CommunitySystem/CommunitySystem.exe")
+    print("(ship the whole dist/CommunitySystem folder)")
 print("="*50)
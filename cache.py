@@ -0,0 +1,43 @@
+"""Per-worker cache of reference data.
+
+Organizations, event types and cost types are read by most pages but
+rarely change. Each worker process keeps its own copy and re-reads a table
+only when that table's row in cache_versions has moved. Triggers on the
+tables bump the version (see init_db), so a change made through any
+worker - or a script, or another host sharing the database - invalidates
+every worker's copy on its next read.
+"""
+import threading
+
+from database import CACHED_TABLES
+
+QUERIES = {
+    'organizations': 'SELECT * FROM organizations ORDER BY name',
+    'event_types': 'SELECT * FROM event_types ORDER BY name',
+    'cost_types': 'SELECT * FROM cost_types ORDER BY name',
+}
+assert set(QUERIES) == set(CACHED_TABLES)
+
+_cache = {}  # table -> (version, rows)
+_lock = threading.Lock()
+
+
+def reference_rows(cursor, table):
+    """All rows of a reference table, from this worker's cache if still current"""
+    # version first: a change landing in between just means one extra reload
+    cursor.execute('SELECT version FROM cache_versions WHERE name = ?', (table,))
+    version = cursor.fetchone()[0]
+    cached = _cache.get(table)
+    if cached and cached[0] == version:
+        return cached[1]
+    cursor.execute(QUERIES[table])
+    rows = cursor.fetchall()
+    with _lock:
+        _cache[table] = (version, rows)
+    return rows
+
+
+def reset():
+    """Drop everything cached (e.g. state copied into a freshly forked worker)"""
+    with _lock:
+        _cache.clear()
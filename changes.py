@@ -0,0 +1,116 @@
+"""Change feed for incremental sync.
+
+Triggers (see init_db) append a row to change_log for every insert, update
+and delete on the synced tables. Mirrors keep the last seq they saw and
+ask for everything after it, so each sync only moves the deltas:
+
+    GET /api/changes?since=<seq>&limit=500
+
+op is 'insert', 'update', 'delete', or 'archive' when archive.py moved the
+row into cold storage rather than it being deleted.
+
+Compaction keeps only the newest log entry per row, which is all a mirror
+needs to converge:
+
+    python changes.py compact
+
+With SHARDS_DIR set, each organization's events, cost entries and
+distributions are logged in its own shard and synced with
+/api/changes?org_id=<id>; the plain feed carries the common tables and
+says so with "sharded": true, the list of shards and a warning.
+"""
+import argparse
+
+from database import get_db, init_db, CHANGE_LOG_TABLES
+from shards import shard_orgs, shard_path
+
+DEFAULT_BATCH = 500
+MAX_BATCH = 5000
+
+
+def fetch_changes(cursor, since=0, limit=DEFAULT_BATCH):
+    """Changes after seq `since`, with the current row attached"""
+    limit = max(1, min(limit, MAX_BATCH))
+    cursor.execute('SELECT * FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?', (since, limit + 1))
+    entries = cursor.fetchall()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    # load the current rows one query per table
+    wanted = {}
+    for e in entries:
+        if e['op'] in ('insert', 'update'):
+            wanted.setdefault(e['table_name'], set()).add(e['row_id'])
+    rows = {}
+    for table, ids in wanted.items():
+        ids = list(ids)
+        placeholders = ','.join('?' * len(ids))
+        cursor.execute(f'SELECT * FROM {table} WHERE id IN ({placeholders})', ids)
+        for row in cursor.fetchall():
+            rows[(table, row['id'])] = dict(row)
+
+    changes = []
+    for e in entries:
+        changes.append({
+            'seq': e['seq'],
+            'table': e['table_name'],
+            'id': e['row_id'],
+            'op': e['op'],
+            'changed_at': e['changed_at'],
+            # None if the row has since been deleted; a later entry says so
+            'row': rows.get((e['table_name'], e['row_id'])) if e['op'] in ('insert', 'update') else None,
+        })
+
+    return {
+        'changes': changes,
+        'cursor': entries[-1]['seq'] if entries else since,
+        'has_more': has_more,
+    }
+
+
+def compact_changes(before_seq=None, shard=None):
+    """Drop superseded entries, keeping the newest one per row.
+
+    Only entries below before_seq are touched, so a mirror that is
+    mid-sync past that point still sees every change after it.
+    """
+    conn = get_db(shard)
+    cursor = conn.cursor()
+    if before_seq is None:
+        cursor.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM change_log')
+        before_seq = cursor.fetchone()[0]
+    cursor.execute('''
+        DELETE FROM change_log
+        WHERE seq < ? AND seq NOT IN (
+            SELECT MAX(seq) FROM change_log GROUP BY table_name, row_id
+        )
+    ''', (before_seq,))
+    removed = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Change feed maintenance')
+    sub = parser.add_subparsers(dest='command', required=True)
+    compact = sub.add_parser('compact', help='keep only the newest entry per row')
+    compact.add_argument('--before', type=int, help='only compact entries below this seq (in each log)')
+    sub.add_parser('status', help='show change log size')
+    args = parser.parse_args()
+
+    init_db()
+    # the common log, then each organization's shard (each has its own seq)
+    databases = [('common', None)] + [(f'org {org_id}', shard_path(org_id)) for org_id in shard_orgs()]
+    for label, shard in databases:
+        if len(databases) > 1:
+            print(f"[{label}]")
+        if args.command == 'compact':
+            print(f"Removed {compact_changes(args.before, shard)} superseded entries")
+        else:
+            conn = get_db(shard)
+            for table in CHANGE_LOG_TABLES:
+                count = conn.execute('SELECT COUNT(*) FROM main.change_log WHERE table_name = ?', (table,)).fetchone()[0]
+                print(f"{table}: {count}")
+            print(f"latest seq: {conn.execute('SELECT COALESCE(MAX(seq), 0) FROM main.change_log').fetchone()[0]}")
+            conn.close()
@@ -2,22 +2,94 @@ import sqlite3
 import os
 from datetime import datetime
 
-# database location - use /data for cloud, otherwise local
-if os.path.exists('/data'):
+# database location - DATABASE env, /data for cloud, otherwise local
+if os.environ.get('DATABASE'):
+    DATABASE = os.environ['DATABASE']
+elif os.path.exists('/data'):
     DATABASE = '/data/community.db'
 else:
     DATABASE = 'community.db'
 
-def get_db():
-    conn = sqlite3.connect(DATABASE)
+# tables whose writes are recorded in change_log (see changes.py)
+CHANGE_LOG_TABLES = ['event_profiles', 'cost_entries', 'profit_distributions', 'volunteers', 'organizations']
+# updates that aren't logged: the event_day triggers re-keying a row whose
+# event_date didn't change in that statement
+CHANGE_LOG_SKIP_UPDATE = {
+    'event_profiles': 'OLD.event_day IS NOT NEW.event_day AND OLD.event_date IS NEW.event_date',
+}
+
+# reference tables cached per worker, versioned in cache_versions (see cache.py)
+CACHED_TABLES = ['organizations', 'event_types', 'cost_types']
+
+# cost_types.flags bits - what a cost type counts as in KPIs and reports
+COST_FLAG_LABOR = 1
+COST_FLAG_IN_KIND = 2
+COST_FLAG_DONATION = 4
+COST_FLAG_FACILITY = 8
+COST_FLAGS = [(COST_FLAG_LABOR, 'Labor'), (COST_FLAG_IN_KIND, 'In-Kind'),
+              (COST_FLAG_DONATION, 'Donation'), (COST_FLAG_FACILITY, 'Facility')]
+
+# closed fiscal years are moved into one SQLite file per year under here
+ARCHIVE_DIR = os.path.join(os.path.dirname(DATABASE), 'archive')
+
+# online backups (see backup.py)
+BACKUP_DIR = os.environ.get('BACKUP_DIR', os.path.join(os.path.dirname(DATABASE), 'backups'))
+
+# optional callback that sees every SQL statement (used by query_plans.py)
+SQL_TRACE = None
+
+# optional callback run on every new connection (budget.py sets it)
+ON_CONNECT = None
+
+# per-organization shard files (see shards.py) - off unless SHARDS_DIR is set
+SHARDS_DIR = os.environ.get('SHARDS_DIR')
+
+# optional callback giving the shard the running request was routed to (shards.py sets it)
+SHARD_ROUTER = None
+
+def get_db(shard=None):
+    # shard is an organization's shard file; the common database is attached
+    # to it so reference tables resolve there
+    if shard is None and SHARD_ROUTER:
+        shard = SHARD_ROUTER()
+    conn = sqlite3.connect(shard or DATABASE)
     conn.row_factory = sqlite3.Row
+    if shard:
+        conn.execute('ATTACH DATABASE ? AS common', (DATABASE,))
+    if SQL_TRACE:
+        conn.set_trace_callback(SQL_TRACE)
+    if ON_CONNECT:
+        ON_CONNECT(conn)
     return conn
 
+def add_column(cursor, table, column, decl):
+    # ALTER TABLE for databases created before the column existed
+    # returns True if the column was added
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+        return True
+    return False
+
+def replace_trigger(cursor, name, sql):
+    # CREATE TRIGGER that also replaces an older definition of the trigger
+    # (sqlite_master keeps the statement as written, from CREATE on)
+    sql = sql.strip()
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,))
+    row = cursor.fetchone()
+    if row is not None and row[0] == sql:
+        return
+    cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+    cursor.execute(sql)
+
 def init_db():
     # create tables if they don't exist
     conn = get_db()
     cursor = conn.cursor()
     
+    # WAL so readers in other workers/processes aren't blocked by a writer
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
     # event types table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS event_types (
@@ -60,7 +132,8 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL UNIQUE,
             default_rate REAL DEFAULT 0,
-            description TEXT
+            description TEXT,
+            flags INTEGER DEFAULT 0
         )
     ''')
     
@@ -89,6 +162,7 @@ def init_db():
             entry_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             quarter TEXT,
             year INTEGER,
+            event_day INTEGER,
             FOREIGN KEY (event_type_id) REFERENCES event_types(id),
             FOREIGN KEY (organization_id) REFERENCES organizations(id),
             FOREIGN KEY (lens_category_id) REFERENCES lens_categories(id),
@@ -156,24 +230,189 @@ def init_db():
         )
     ''')
     
+    # Table: archived_years (years moved out to cold storage, see archive.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_years (
+            year INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Table: archive_summaries (precomputed event totals for archived years)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_summaries (
+            year INTEGER NOT NULL,
+            quarter TEXT,
+            organization_id INTEGER,
+            event_type_id INTEGER,
+            event_count INTEGER DEFAULT 0,
+            participants INTEGER DEFAULT 0,
+            total_income REAL DEFAULT 0,
+            total_expense REAL DEFAULT 0,
+            net_profit REAL DEFAULT 0
+        )
+    ''')
+    
+    # Table: archive_cost_summaries (precomputed cost totals for archived years)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_cost_summaries (
+            year INTEGER NOT NULL,
+            quarter TEXT,
+            organization_id INTEGER,
+            cost_type_id INTEGER,
+            cost_type_name TEXT,
+            is_income INTEGER DEFAULT 0,
+            total REAL DEFAULT 0,
+            total_hours REAL DEFAULT 0,
+            hours_value REAL DEFAULT 0
+        )
+    ''')
+    
+    # Table: change_log (append-only change feed, filled by triggers)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Table: live_updates (messages for open /stream pages in every worker, see notify.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS live_updates (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            message TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Table: shard_directory (rows moved into an organization's shard, see shards.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shard_directory (
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            organization_id INTEGER NOT NULL,
+            PRIMARY KEY (table_name, row_id)
+        ) WITHOUT ROWID
+    ''')
+    
+    flags_added = add_column(cursor, 'cost_types', 'flags', 'INTEGER DEFAULT 0')
+    
+    # event_day is the event date as an integer YYYYMMDD key so period
+    # filters can use an index range scan instead of comparing TEXT dates
+    add_column(cursor, 'event_profiles', 'event_day', 'INTEGER')
+    cursor.execute('''
+        UPDATE event_profiles SET event_day = CAST(strftime('%Y%m%d', event_date) AS INTEGER)
+        WHERE event_day IS NULL
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS event_profiles_day_insert
+        AFTER INSERT ON event_profiles
+        BEGIN
+            UPDATE event_profiles SET event_day = CAST(strftime('%Y%m%d', NEW.event_date) AS INTEGER)
+            WHERE id = NEW.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS event_profiles_day_update
+        AFTER UPDATE OF event_date ON event_profiles
+        BEGIN
+            UPDATE event_profiles SET event_day = CAST(strftime('%Y%m%d', NEW.event_date) AS INTEGER)
+            WHERE id = NEW.id;
+        END
+    ''')
+    
+    # Distribution amounts follow the event's net profit (see distributions.py)
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS event_profiles_net_profit_update
+        AFTER UPDATE OF net_profit ON event_profiles
+        WHEN OLD.net_profit IS NOT NEW.net_profit
+        BEGIN
+            UPDATE profit_distributions SET amount = NEW.net_profit * percentage / 100
+            WHERE event_id = NEW.id;
+        END
+    ''')
+    
+    # Reference data versions - any write bumps the table's version so every
+    # worker's cached copy is re-read (see cache.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for table in CACHED_TABLES:
+        cursor.execute('INSERT OR IGNORE INTO cache_versions (name) VALUES (?)', (table,))
+        for op in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_cache_{op.lower()}
+                AFTER {op} ON {table}
+                BEGIN
+                    UPDATE cache_versions SET version = version + 1 WHERE name = '{table}';
+                END
+            ''')
+    
+    # Change feed triggers - every write to a synced table appends to change_log
+    for table in CHANGE_LOG_TABLES:
+        for op, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            skip = CHANGE_LOG_SKIP_UPDATE.get(table) if op == 'UPDATE' else None
+            when = f'\n                WHEN NOT ({skip})' if skip else ''
+            replace_trigger(cursor, f'{table}_change_{op.lower()}', f'''
+                CREATE TRIGGER {table}_change_{op.lower()}
+                AFTER {op} ON {table}{when}
+                BEGIN
+                    INSERT INTO change_log (table_name, row_id, op) VALUES ('{table}', {row}.id, '{op.lower()}');
+                END
+            ''')
+    
+    # Indexes for period filters and the cost_entries -> event join
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_event_profiles_day_org ON event_profiles (event_day, organization_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cost_entries_event ON cost_entries (event_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_profit_distributions_event ON profit_distributions (event_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cost_entries_type ON cost_entries (cost_type_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archive_summaries_year ON archive_summaries (year)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archive_cost_summaries_year ON archive_cost_summaries (year)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_change_log_row ON change_log (table_name, row_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cost_entries_volunteer ON cost_entries (volunteer_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_volunteers_name ON volunteers (name)')
+    
     # Insert default event types
     default_types = [('School', 'School related activities'), ('Church', 'Church related activities'), 
                      ('Community', 'Community related activities'), ('Other', 'Other activities')]
     for name, desc in default_types:
         cursor.execute('INSERT OR IGNORE INTO event_types (name, description) VALUES (?, ?)', (name, desc))
     
-    # Insert default cost types with rates
+    # Insert default cost types with rates and classification flags
     default_costs = [
-        ('Labor', 15.00, 'Volunteer labor hours'),
-        ('Facility', 25.00, 'Facility rental/usage'),
-        ('In-Kind', 0, 'In-kind donations'),
-        ('Donations', 0, 'Cash donations received'),
-        ('Food', 0, 'Food costs'),
-        ('Supply', 0, 'Supply costs'),
-        ('Other', 0, 'Other costs')
+        ('Labor', 15.00, 'Volunteer labor hours', COST_FLAG_LABOR),
+        ('Facility', 25.00, 'Facility rental/usage', COST_FLAG_FACILITY),
+        ('In-Kind', 0, 'In-kind donations', COST_FLAG_IN_KIND),
+        ('Donations', 0, 'Cash donations received', COST_FLAG_DONATION),
+        ('Food', 0, 'Food costs', 0),
+        ('Supply', 0, 'Supply costs', 0),
+        ('Other', 0, 'Other costs', 0)
     ]
-    for name, rate, desc in default_costs:
-        cursor.execute('INSERT OR IGNORE INTO cost_types (name, default_rate, description) VALUES (?, ?, ?)', (name, rate, desc))
+    for name, rate, desc, flags in default_costs:
+        cursor.execute('INSERT OR IGNORE INTO cost_types (name, default_rate, description, flags) VALUES (?, ?, ?, ?)',
+                       (name, rate, desc, flags))
+    
+    # cost_types.flags migration: classify the default types and reconcile
+    # the denormalized cost_type_id/cost_type_name pairs on cost_entries
+    if flags_added:
+        for name, rate, desc, flags in default_costs:
+            cursor.execute('UPDATE cost_types SET flags = ? WHERE name = ?', (flags, name))
+        cursor.execute('''
+            UPDATE cost_entries SET cost_type_id = (SELECT id FROM cost_types WHERE name = cost_entries.cost_type_name)
+            WHERE cost_type_id IS NULL AND cost_type_name IN (SELECT name FROM cost_types)
+        ''')
+        cursor.execute('''
+            UPDATE cost_entries SET cost_type_name = (SELECT name FROM cost_types WHERE id = cost_entries.cost_type_id)
+            WHERE cost_type_id IN (SELECT id FROM cost_types)
+              AND cost_type_name IS NOT (SELECT name FROM cost_types WHERE id = cost_entries.cost_type_id)
+        ''')
     
     # Insert LENS categories and subcategories
     lens_data = [
@@ -202,6 +441,11 @@ def init_db():
     
     conn.commit()
     conn.close()
+    
+    # shards hold their own copies of the event tables - migrate them too
+    if SHARDS_DIR:
+        from shards import migrate_shards
+        migrate_shards()
 
 def calculate_quarter(date_str):
     """Calculate quarter from date"""
@@ -209,6 +453,10 @@ def calculate_quarter(date_str):
     quarter = (date.month - 1) // 3 + 1
     return f"{date.year}Q{quarter}", date.year, quarter
 
+def date_key(d):
+    """Integer YYYYMMDD key for a date, matches event_profiles.event_day"""
+    return d.year * 10000 + d.month * 100 + d.day
+
 if __name__ == '__main__':
     init_db()
     print("Database initialized!")
@@ -0,0 +1,101 @@
+"""Profit distribution engine.
+
+A distribution stores a percentage of its event's net profit. The amount
+is kept in step by the event_profiles_net_profit_update trigger, which
+re-prices every distribution of an event in one UPDATE whenever its
+net_profit changes. For data entered before that trigger existed:
+
+    python distributions.py recompute     # refresh event totals + all amounts
+    python distributions.py check         # list over-allocated events
+
+With SHARDS_DIR set both run over every organization's shard.
+"""
+import argparse
+
+from database import get_db, init_db
+from shards import shard_orgs, shard_path
+
+MAX_PERCENTAGE = 100
+# percentages are compared rounded to this many places
+PERCENTAGE_PLACES = 6
+
+
+def allocated_percentage(cursor, event_id):
+    """Percentage of an event's net profit already distributed"""
+    cursor.execute('SELECT COALESCE(SUM(percentage), 0) FROM profit_distributions WHERE event_id = ?', (event_id,))
+    return cursor.fetchone()[0]
+
+
+def over_allocated(cursor):
+    """Events whose distributions add up to more than 100%"""
+    cursor.execute('''
+        SELECT pd.event_id, ep.event_name, SUM(pd.percentage) as total_percentage
+        FROM profit_distributions pd
+        LEFT JOIN event_profiles ep ON pd.event_id = ep.id
+        GROUP BY pd.event_id
+        HAVING ROUND(SUM(pd.percentage), ?) > ?
+    ''', (PERCENTAGE_PLACES, MAX_PERCENTAGE))
+    return cursor.fetchall()
+
+
+def recompute_all(shard=None):
+    """Recompute stored event totals and every distribution amount, set-based.
+
+    Returns (events updated, distributions updated).
+    """
+    conn = get_db(shard)
+    cursor = conn.cursor()
+
+    # event totals from cost entries; the trigger re-prices distributions
+    # of the events whose net profit moves
+    cursor.execute('''
+        UPDATE event_profiles
+        SET total_income = s.income, total_expense = s.expense, net_profit = s.income - s.expense
+        FROM (
+            SELECT ep.id,
+                   COALESCE(SUM(CASE WHEN ce.is_income = 1 THEN ce.amount END), 0) as income,
+                   COALESCE(SUM(CASE WHEN ce.is_income = 0 THEN ce.amount END), 0) as expense
+            FROM event_profiles ep
+            LEFT JOIN cost_entries ce ON ce.event_id = ep.id
+            GROUP BY ep.id
+        ) s
+        WHERE s.id = event_profiles.id
+          AND (event_profiles.total_income IS NOT s.income OR event_profiles.total_expense IS NOT s.expense)
+    ''')
+    events = cursor.rowcount
+
+    # anything still stale (e.g. net profit was already right but amounts weren't)
+    cursor.execute('''
+        UPDATE profit_distributions
+        SET amount = COALESCE((SELECT net_profit FROM event_profiles WHERE id = profit_distributions.event_id), 0) * percentage / 100
+        WHERE amount IS NOT COALESCE((SELECT net_profit FROM event_profiles WHERE id = profit_distributions.event_id), 0) * percentage / 100
+    ''')
+    distributions = cursor.rowcount
+
+    conn.commit()
+    conn.close()
+    return events, distributions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profit distribution maintenance')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('recompute', help='recompute event totals and all distribution amounts')
+    sub.add_parser('check', help='list events distributing more than 100%%')
+    args = parser.parse_args()
+
+    init_db()
+    databases = [None] + [shard_path(org_id) for org_id in shard_orgs()]
+    if args.command == 'recompute':
+        events, distributions = map(sum, zip(*(recompute_all(shard) for shard in databases)))
+        print(f"Updated totals for {events} events and {distributions} other distributions")
+    else:
+        rows = []
+        for shard in databases:
+            conn = get_db(shard)
+            rows += over_allocated(conn.cursor())
+            conn.close()
+        for row in rows:
+            print(f"#{row['event_id']} {row['event_name']}: {row['total_percentage']}%")
+        if not rows:
+            print("All events are within 100%")
@@ -0,0 +1,162 @@
+"""Batched event fetches and bulk changes for the JSON API.
+
+Clients (kiosks, mobile check-in) ask for many events at once and get
+each one's breakdown and distributions in the same response. Every part is
+one query per chunk of ids (WHERE ... IN (...)), never one per event:
+
+    GET  /api/events?ids=1,2,3&fields=id,event_name,net_profit&include=breakdown
+    POST /api/events/fetch   {"ids": [...], "fields": [...], "include": [...]}
+    POST /api/events/bulk    {"ids": [...], "action": "status", "status": "Completed"}
+    POST /api/events/bulk    {"ids": [...], "action": "delete"}
+
+fields picks event columns (plus event_type_name and org_name), so a
+kiosk showing names and dates doesn't download notes and contact details.
+"""
+MAX_IDS = 1000
+# ids per IN (...) - well under SQLite's bound parameter limit
+CHUNK = 500
+
+EVENT_STATUSES = ('In Progress', 'Completed')
+INCLUDES = ('breakdown', 'distributions')
+JOINED_FIELDS = {
+    'event_type_name': ('et.name', 'LEFT JOIN event_types et ON ep.event_type_id = et.id'),
+    'org_name': ('o.name', 'LEFT JOIN organizations o ON ep.organization_id = o.id'),
+}
+
+
+def chunks(ids):
+    for i in range(0, len(ids), CHUNK):
+        batch = ids[i:i + CHUNK]
+        yield batch, ','.join('?' * len(batch))
+
+
+def event_fields(cursor):
+    """Every field a client may ask for"""
+    cursor.execute('PRAGMA table_info(event_profiles)')
+    return [row[1] for row in cursor.fetchall()] + list(JOINED_FIELDS)
+
+
+def parse_ids(value):
+    """List of event ids from "1,2,3" or a JSON list; raises ValueError"""
+    if isinstance(value, str):
+        value = [v for v in value.split(',') if v.strip()]
+    if not isinstance(value, list):
+        raise ValueError('ids must be a list')
+    try:
+        ids = list(dict.fromkeys(int(v) for v in value))
+    except (TypeError, ValueError):
+        raise ValueError('ids must be a list of event ids')
+    if len(ids) > MAX_IDS:
+        raise ValueError(f'At most {MAX_IDS} ids per request')
+    return ids
+
+
+def parse_list(value):
+    """Names from "a,b" or a JSON list of strings; raises ValueError"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(',') if v.strip()]
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise ValueError('fields and include must be a list of names')
+    return value
+
+
+def fetch_events(cursor, ids, fields=None, include=()):
+    """Events by id, in the order asked for, with optional breakdown/distributions.
+
+    Returns (events, missing ids). Raises ValueError for unknown fields/includes.
+    """
+    known = event_fields(cursor)
+    fields = fields or [f for f in known if f not in JOINED_FIELDS]
+    unknown = [f for f in fields if f not in known] + [i for i in include if i not in INCLUDES]
+    if unknown:
+        raise ValueError(f"Unknown field or include: {', '.join(unknown)}")
+    if 'id' not in fields:
+        fields = ['id'] + list(fields)
+
+    columns, joins = [], []
+    for f in fields:
+        if f in JOINED_FIELDS:
+            expr, join = JOINED_FIELDS[f]
+            columns.append(f'{expr} as {f}')
+            joins.append(join)
+        else:
+            columns.append(f'ep.{f}')
+
+    found = {}
+    for batch, placeholders in chunks(ids):
+        cursor.execute(f'''
+            SELECT {', '.join(columns)}
+            FROM event_profiles ep {' '.join(joins)}
+            WHERE ep.id IN ({placeholders})
+        ''', batch)
+        for row in cursor.fetchall():
+            found[row['id']] = dict(row)
+    events = [found[i] for i in ids if i in found]
+    present = [e['id'] for e in events]
+
+    if 'breakdown' in include:
+        for e in events:
+            e['breakdown'] = []
+            e['totals'] = {'total_hours': 0, 'total_income': 0, 'total_expense': 0}
+        for batch, placeholders in chunks(present):
+            cursor.execute(f'''
+                SELECT ce.event_id, ce.cost_type_id, COALESCE(ct.name, MAX(ce.cost_type_name)) as cost_type_name,
+                       SUM(ce.hours) as hours,
+                       SUM(CASE WHEN ce.is_income = 1 THEN ce.amount ELSE 0 END) as income,
+                       SUM(CASE WHEN ce.is_income = 0 THEN ce.amount ELSE 0 END) as expense
+                FROM cost_entries ce
+                LEFT JOIN cost_types ct ON ce.cost_type_id = ct.id
+                WHERE ce.event_id IN ({placeholders})
+                GROUP BY ce.event_id, ce.cost_type_id
+            ''', batch)
+            for row in cursor.fetchall():
+                event = found[row['event_id']]
+                line = dict(row)
+                del line['event_id']
+                event['breakdown'].append(line)
+                event['totals']['total_hours'] += row['hours'] or 0
+                event['totals']['total_income'] += row['income'] or 0
+                event['totals']['total_expense'] += row['expense'] or 0
+
+    if 'distributions' in include:
+        for e in events:
+            e['distributions'] = []
+        for batch, placeholders in chunks(present):
+            cursor.execute(f'''
+                SELECT pd.*, o.name as org_name
+                FROM profit_distributions pd
+                LEFT JOIN organizations o ON pd.target_organization_id = o.id
+                WHERE pd.event_id IN ({placeholders})
+            ''', batch)
+            for row in cursor.fetchall():
+                found[row['event_id']]['distributions'].append(dict(row))
+
+    return events, [i for i in ids if i not in found]
+
+
+def bulk_set_status(cursor, ids, status):
+    """Set status on many events; returns how many changed"""
+    if status not in EVENT_STATUSES:
+        raise ValueError(f"status must be one of: {', '.join(EVENT_STATUSES)}")
+    changed = 0
+    for batch, placeholders in chunks(ids):
+        # skip rows already there so they don't land in the change log
+        cursor.execute(f'''
+            UPDATE event_profiles SET status = ?
+            WHERE id IN ({placeholders}) AND status IS NOT ?
+        ''', [status] + batch + [status])
+        changed += cursor.rowcount
+    return changed
+
+
+def bulk_delete(cursor, ids):
+    """Delete many events with their cost entries and distributions; returns events deleted"""
+    deleted = 0
+    for batch, placeholders in chunks(ids):
+        cursor.execute(f'DELETE FROM cost_entries WHERE event_id IN ({placeholders})', batch)
+        cursor.execute(f'DELETE FROM profit_distributions WHERE event_id IN ({placeholders})', batch)
+        cursor.execute(f'DELETE FROM event_profiles WHERE id IN ({placeholders})', batch)
+        deleted += cursor.rowcount
+    return deleted
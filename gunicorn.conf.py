@@ -0,0 +1,45 @@
+"""gunicorn settings - picked up automatically by `gunicorn app:app`.
+
+Every setting comes from the environment so the same file works on a
+laptop and behind a load balancer:
+
+    PORT / BIND          listen address (default 0.0.0.0:8000)
+    WEB_CONCURRENCY      worker processes (default 2 x cores + 1)
+    GUNICORN_THREADS     threads per worker (default 8; /stream holds one)
+    GUNICORN_TIMEOUT     seconds before a stuck worker is restarted
+    PRELOAD_APP          import the app once in the master (default 1)
+
+All workers (and hosts) must share SECRET_KEY, DATABASE and SHARDS_DIR; see app.py.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+preload_app = os.environ.get('PRELOAD_APP', '1') == '1'
+
+# scheduled backups run once, in the master - not once per worker
+BACKUP_INTERVAL_HOURS = os.environ.pop('BACKUP_INTERVAL_HOURS', None)
+
+
+def on_starting(server):
+    # schema and migrations once, before any worker serves a request
+    from database import init_db
+    init_db()
+
+
+def when_ready(server):
+    if BACKUP_INTERVAL_HOURS:
+        from backup import start_scheduler
+        start_scheduler(float(BACKUP_INTERVAL_HOURS),
+                        compress=os.environ.get('BACKUP_COMPRESS') == '1',
+                        keep=int(os.environ.get('BACKUP_KEEP', 7)))
+
+
+def post_fork(server, worker):
+    # drop anything the preloaded master cached before forking
+    from app import init_worker
+    init_worker()
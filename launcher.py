@@ -1,21 +1,74 @@
-import webbrowser
 import time
+STARTED = time.perf_counter()
+
+import argparse
+import os
+import socket
 import threading
-from app import app, init_db
+from datetime import datetime
+
+# appended to on every start so slow launches of the windowed exe can be measured
+STARTUP_LOG = os.environ.get('STARTUP_LOG', 'startup.log')
+
+def open_browser(url):
+    # imported here - webbrowser pulls in subprocess & co, which the server doesn't need
+    import webbrowser
+    webbrowser.open(url)
 
-def open_browser():
-    # wait a bit for server to start
-    time.sleep(1.5)
-    webbrowser.open('http://127.0.0.1:5000')
+def free_port(port):
+    # werkzeug exits if the port is taken, so check first; 0 lets the OS pick
+    with socket.socket() as s:
+        try:
+            s.bind(('127.0.0.1', port))
+        except OSError:
+            return 0
+    return port
+
+def report_startup(timings):
+    line = ', '.join(f'{name} {seconds * 1000:.0f} ms' for name, seconds in timings)
+    print(f"Started in {line}")
+    try:
+        with open(STARTUP_LOG, 'a') as f:
+            f.write(f"{datetime.now().isoformat(timespec='seconds')} {line}\n")
+    except OSError:
+        pass
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Community Contribution Tracking System')
+    parser.add_argument('--port', type=int, default=5000, help='port to listen on (a free one is picked if taken)')
+    parser.add_argument('--no-browser', action='store_true', help="don't open the browser")
+    parser.add_argument('--startup-check', action='store_true', help='exit as soon as the server is listening')
+    args = parser.parse_args()
+
+    from werkzeug.serving import make_server
+    from app import app, init_db
+    imported = time.perf_counter()
+
     init_db()
-    
-    # open browser in background thread
-    threading.Thread(target=open_browser, daemon=True).start()
-    
+    ready_db = time.perf_counter()
+
+    # the socket is bound and listening once make_server returns, so the
+    # browser can open right away instead of after a guessed delay
+    server = make_server('127.0.0.1', free_port(args.port), app, threaded=True)
+    listening = time.perf_counter()
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    report_startup([('total', listening - STARTED),
+                    ('imports', imported - STARTED),
+                    ('init_db', ready_db - imported),
+                    ('listen', listening - ready_db)])
+    if args.startup_check:
+        server.server_close()
+        raise SystemExit(0)
+
+    if not args.no_browser:
+        threading.Thread(target=open_browser, args=(url,), daemon=True).start()
+
     print("Starting Community Contribution Tracking System...")
-    print("Opening browser at http://127.0.0.1:5000")
+    print(f"Open {url} in your browser")
     print("Press Ctrl+C to quit")
-    
-    app.run(debug=True, port=5000, use_reloader=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
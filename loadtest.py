@@ -0,0 +1,161 @@
+"""Multi-process load test against gunicorn.
+
+Starts gunicorn with several workers on a seeded throwaway database (see
+gunicorn.conf.py), then runs client processes against it and checks what
+breaks when state is per-process:
+
+- sessions: a flash message set by one request is shown by the next,
+  whichever worker serves it
+- reference cache: an organization added through one worker is listed by
+  every worker straight away
+- no request fails under concurrent reads and writes
+
+    python loadtest.py                              # 4 workers, 8 clients
+    python loadtest.py --workers 8 --clients 16 --requests 500
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from query_plans import seed
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (label, method, path, form) - {event} is filled with a random event id
+MIX = [
+    ('dashboard', 'GET', '/', None),
+    ('dashboard quarter', 'GET', '/?period=quarterly&year=2024&quarter=2', None),
+    ('event list', 'GET', '/events', None),
+    ('view event', 'GET', '/events/{event}', None),
+    ('edit event', 'GET', '/events/{event}/edit', None),
+    ('organizations', 'GET', '/organizations', None),
+    ('quarterly report', 'POST', '/reports/generate', {'report_type': 'quarterly', 'quarter': '2024Q3'}),
+    ('add cost entry', 'POST', '/events/{event}/costs/add', {'cost_type_id': '1', 'hours': '2'}),
+]
+
+
+def fetch(port, method, path, form=None, cookie=None):
+    """One request on a fresh connection, so requests spread over the workers"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    headers = {'Cookie': cookie} if cookie else {}
+    body = None
+    if form is not None:
+        body = urlencode(form)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    data = response.read().decode('utf-8', 'replace')
+    conn.close()
+    return response.status, response.getheader('Set-Cookie'), data
+
+
+def client(job):
+    port, requests, events, client_seed = job
+    rng = random.Random(client_seed)
+    results = []
+    for _ in range(requests):
+        label, method, path, form = rng.choice(MIX)
+        started = time.perf_counter()
+        try:
+            status = fetch(port, method, path.format(event=rng.randint(1, events)), form)[0]
+        except OSError as e:
+            status = repr(e)
+        results.append((label, status, time.perf_counter() - started))
+    return results
+
+
+def check_sessions(port, tries):
+    # flash is stored in the signed session cookie set by the POST
+    failures = 0
+    for i in range(tries):
+        _, cookie, _ = fetch(port, 'POST', '/organizations/add', {'name': f'Session Org {i}'})
+        _, _, page = fetch(port, 'GET', '/organizations', cookie=cookie.split(';')[0] if cookie else None)
+        if 'Organization added successfully!' not in page:
+            failures += 1
+    return failures
+
+
+def check_invalidation(port, workers):
+    # warm every worker's cache, change the data through one, read through all
+    for _ in range(workers * 4):
+        fetch(port, 'GET', '/organizations')
+    name = f'Invalidation Org {time.time()}'
+    fetch(port, 'POST', '/organizations/add', {'name': name})
+    return sum(name not in fetch(port, 'GET', '/organizations')[2] for _ in range(workers * 4))
+
+
+def wait_listening(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(workers, clients, requests, events, port):
+    path = os.path.join(tempfile.mkdtemp(), 'load.db')
+    print(f"Seeding {events} events into {path} ...")
+    seed(path, events)
+
+    env = dict(os.environ, DATABASE=path, WEB_CONCURRENCY=str(workers), BIND=f'127.0.0.1:{port}',
+               QUERY_BUDGET_SECONDS='0', REPORT_BUDGET_SECONDS='0')
+    env.pop('SECRET_KEY', None)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app', '--log-level', 'warning'],
+                              cwd=HERE, env=env)
+    try:
+        if not wait_listening(port):
+            print("gunicorn did not start")
+            return False
+
+        session_failures = check_sessions(port, workers * 5)
+        print(f"sessions:     {workers * 5 - session_failures}/{workers * 5} flashes seen on the next request")
+        stale = check_invalidation(port, workers)
+        print(f"invalidation: {workers * 4 - stale}/{workers * 4} reads saw an organization added via another worker")
+
+        started = time.perf_counter()
+        with multiprocessing.Pool(clients) as pool:
+            jobs = [(port, requests, events, n) for n in range(clients)]
+            results = [r for batch in pool.map(client, jobs) for r in batch]
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+
+    errors = [r for r in results if not isinstance(r[1], int) or r[1] >= 500]
+    print(f"\n{len(results)} requests from {clients} clients to {workers} workers in {elapsed:.1f}s "
+          f"({len(results) / elapsed:.0f} req/s), {len(errors)} errors")
+    print(f"{'route':<20}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}")
+    for label, _, _, _ in MIX:
+        times = [r[2] * 1000 for r in results if r[0] == label]
+        if times:
+            print(f"{label:<20}{len(times):>7}{percentile(times, 50):>9.0f}{percentile(times, 95):>9.0f}")
+    for label, status, _ in errors[:10]:
+        print(f"  error: {label} -> {status}")
+    return not errors and not session_failures and not stale
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the app under multiple gunicorn workers')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=8, help='client processes')
+    parser.add_argument('--requests', type=int, default=100, help='requests per client')
+    parser.add_argument('--events', type=int, default=2000, help='events to seed')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.workers, args.clients, args.requests, args.events, args.port) else 1)
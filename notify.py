@@ -0,0 +1,95 @@
+"""Notification bus for live page updates.
+
+Write routes publish a small message after they commit. Messages are
+written to the live_updates table, so every worker process (and every host
+sharing the database) sees them: one poller thread per process reads the
+new rows and hands them to that process's open /stream connections, each of
+which has its own queue and picks out the messages it cares about.
+
+Messages carry their live_updates seq, which /stream sends as the SSE event
+id; rows are kept for KEEP_SECONDS so a reconnecting page can catch up.
+"""
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+from database import get_db
+
+POLL_SECONDS = 0.5
+KEEP_SECONDS = 15 * 60
+PRUNE_EVERY = 60
+
+_subscribers = set()
+_lock = threading.Lock()
+_poller = None
+
+
+def publish(message):
+    """Record message for every worker's listeners"""
+    conn = get_db()
+    conn.execute('INSERT INTO live_updates (message) VALUES (?)', (json.dumps(message),))
+    conn.commit()
+    conn.close()
+
+
+def messages_since(cursor, seq):
+    """(seq, message) pairs published after seq, oldest first"""
+    cursor.execute('SELECT seq, message FROM live_updates WHERE seq > ? ORDER BY seq', (seq,))
+    return [(row['seq'], json.loads(row['message'])) for row in cursor.fetchall()]
+
+
+def subscribe(maxsize=100):
+    """Register a new listener and return its queue of (seq, message)"""
+    q = queue.Queue(maxsize=maxsize)
+    with _lock:
+        _subscribers.add(q)
+        start_poller()
+    return q
+
+
+def unsubscribe(q):
+    with _lock:
+        _subscribers.discard(q)
+
+
+def deliver(seq, message):
+    # slow listeners just miss it
+    with _lock:
+        listeners = list(_subscribers)
+    for q in listeners:
+        try:
+            q.put_nowait((seq, message))
+        except queue.Full:
+            pass
+
+
+def poll():
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM live_updates')
+    last = cursor.fetchone()[0]
+    pruned = time.monotonic()
+    while True:
+        time.sleep(POLL_SECONDS)
+        try:
+            for seq, message in messages_since(cursor, last):
+                deliver(seq, message)
+                last = seq
+            if time.monotonic() - pruned > PRUNE_EVERY:
+                cursor.execute("DELETE FROM live_updates WHERE created_at < datetime('now', ?)",
+                               (f'-{KEEP_SECONDS} seconds',))
+                conn.commit()
+                pruned = time.monotonic()
+        except sqlite3.OperationalError:
+            # database busy - try again next round
+            conn.rollback()
+
+
+def start_poller():
+    # one per process, started by the first subscriber (never in a preloading master)
+    global _poller
+    if _poller is None or not _poller.is_alive():
+        _poller = threading.Thread(target=poll, name='live-updates', daemon=True)
+        _poller.start()
@@ -0,0 +1,111 @@
+"""Pre-rendered static pages.
+
+The LENS demo pages and the community menu pages don't touch the
+database, so they're rendered once at build time into static_pages/
+(plain and gzipped) and served from there with long cache lifetimes.
+Paths that weren't pre-rendered fall back to live rendering.
+
+The community pages are the ones the base.html sidebar links to (read from
+its url_for('community_menu', ...) calls) plus their parent pages, so the
+list follows the menu.
+
+Build (also run by build_exe.py):
+    python prerender.py
+"""
+import gzip
+import os
+import shutil
+
+from flask import current_app, request, send_file
+from jinja2 import nodes
+
+STATIC_PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static_pages')
+CACHE_MAX_AGE = 7 * 24 * 3600
+
+MENU_TEMPLATE = 'base.html'
+COMMUNITY_ARGS = ('category', 'subcategory', 'detail')
+
+_served_paths = None
+
+
+def community_pages(app):
+    """(category, subcategory, detail) of every community page in the sidebar menu"""
+    env = app.jinja_env
+    source = env.loader.get_source(env, MENU_TEMPLATE)[0]
+    pages = set()
+    for call in env.parse(source).find_all(nodes.Call):
+        if not (isinstance(call.node, nodes.Name) and call.node.name == 'url_for' and call.args
+                and isinstance(call.args[0], nodes.Const) and call.args[0].value == 'community_menu'):
+            continue
+        args = {kw.key: kw.value.value for kw in call.kwargs if isinstance(kw.value, nodes.Const)}
+        parts = [args.get(name) for name in COMMUNITY_ARGS]
+        # the parent pages of a menu entry exist too
+        for depth in range(1, len(parts) + 1):
+            if parts[depth - 1] is None:
+                break
+            pages.add(tuple(parts[:depth]) + (None,) * (len(parts) - depth))
+    return sorted(pages, key=lambda parts: [p or '' for p in parts])
+
+
+def page_paths(app):
+    """URL paths of every pre-rendered page"""
+    paths = ['/lens-demo', '/lens-application-list']
+    for parts in community_pages(app):
+        paths.append('/community/' + '/'.join(p for p in parts if p))
+    return paths
+
+
+def page_file(path):
+    return os.path.join(STATIC_PAGES_DIR, path.strip('/'), 'index.html')
+
+
+def serve_prerendered():
+    """Response for the current path if it was pre-rendered, else None"""
+    global _served_paths
+    if not current_app.config.get('SERVE_PRERENDERED'):
+        return None
+    # only the known pages - request.path comes decoded, so it can hold '..'
+    if _served_paths is None:
+        _served_paths = set(page_paths(current_app))
+    if request.path not in _served_paths:
+        return None
+    path = page_file(request.path)
+    if not os.path.isfile(path):
+        return None
+    gzipped = path + '.gz'
+    if 'gzip' in request.headers.get('Accept-Encoding', '') and os.path.isfile(gzipped):
+        response = send_file(gzipped, mimetype='text/html', max_age=CACHE_MAX_AGE)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_file(path, mimetype='text/html', max_age=CACHE_MAX_AGE)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def build(app):
+    """Render every known page into STATIC_PAGES_DIR"""
+    if os.path.exists(STATIC_PAGES_DIR):
+        shutil.rmtree(STATIC_PAGES_DIR)
+    serving = app.config.get('SERVE_PRERENDERED')
+    app.config['SERVE_PRERENDERED'] = False
+    try:
+        client = app.test_client()
+        paths = page_paths(app)
+        for path in paths:
+            response = client.get(path)
+            if response.status_code != 200:
+                raise RuntimeError(f'{path} returned {response.status_code}')
+            target = page_file(path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(response.data)
+            with gzip.open(target + '.gz', 'wb', compresslevel=9) as f:
+                f.write(response.data)
+    finally:
+        app.config['SERVE_PRERENDERED'] = serving
+    return len(paths)
+
+
+if __name__ == '__main__':
+    from app import app
+    print(f"Pre-rendered {build(app)} pages into {STATIC_PAGES_DIR}")
@@ -0,0 +1,195 @@
+"""Query-plan regression check.
+
+Seeds a throwaway database with a realistic amount of data, drives every
+route through the Flask test client, and runs each SQL statement the
+routes issued through EXPLAIN QUERY PLAN. It fails (exit code 1) when a
+statement does a full SCAN of a big table the route isn't expected to
+read in full, or sorts a full scan in a temp B-tree where an index should
+have supplied the order.
+
+    python query_plans.py                 # report problems only
+    python query_plans.py --verbose       # every route's plans
+    python query_plans.py --events 50000  # bigger seed
+"""
+import argparse
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import database
+from database import calculate_quarter, init_db
+
+# tables that grow with usage; anything else is small reference data
+BIG_TABLES = {'event_profiles', 'cost_entries', 'profit_distributions', 'change_log', 'volunteers'}
+ALIASES = {'ep': 'event_profiles', 'ce': 'cost_entries', 'pd': 'profit_distributions', 'v': 'volunteers'}
+
+# (label, method, path, form/json data, big tables the route may read in full, may sort a full scan)
+ROUTES = [
+    ('dashboard to date', 'GET', '/', None, {'event_profiles', 'cost_entries'}, False),
+    ('dashboard quarter', 'GET', '/?period=quarterly&year=2024&quarter=2', None, set(), False),
+    ('dashboard year+org', 'GET', '/?period=annual&year=2023&org_id=3', None, set(), False),
+    ('event list', 'GET', '/events', None, {'event_profiles'}, False),
+    ('view event', 'GET', '/events/1', None, set(), False),
+    ('edit event', 'GET', '/events/1/edit', None, {'volunteers'}, False),
+    ('add cost entry', 'POST', '/events/1/costs/add', {'cost_type_id': '1', 'hours': '2'}, set(), False),
+    ('batch cost entries', 'JSON', '/api/events/1/costs',
+     {'entries': [{'cost_type_id': 1, 'hours': 3, 'volunteer_id': 5}, {'cost_type_id': 4, 'amount': 20, 'is_income': True}]},
+     set(), False),
+    ('add distribution', 'POST', '/events/1/distribution/add', {'target_type': 'General Fund', 'percentage': '5'}, set(), False),
+    ('delete cost entry', 'POST', '/costs/2/delete', {}, set(), False),
+    ('delete distribution', 'POST', '/distribution/2/delete', {}, set(), False),
+    ('delete event', 'POST', '/events/3/delete', {}, set(), False),
+    ('volunteer list', 'GET', '/volunteers', None, {'volunteers'}, False),
+    ('view volunteer', 'GET', '/volunteers/1', None, set(), False),
+    ('delete volunteer', 'POST', '/volunteers/4/delete', {}, set(), False),
+    ('organizations', 'GET', '/organizations', None, set(), False),
+    ('reports page', 'GET', '/reports', None, set(), False),
+    ('quarterly report', 'POST', '/reports/generate', {'report_type': 'quarterly', 'quarter': '2024Q3'}, set(), False),
+    ('annual report', 'POST', '/reports/generate', {'report_type': 'annual', 'year': '2023'}, set(), False),
+    ('all-time report', 'POST', '/reports/generate', {'report_type': 'all'},
+     {'event_profiles', 'cost_entries'}, True),
+    ('change feed', 'GET', '/api/changes?since=1000&limit=500', None, set(), False),
+    ('events api', 'GET', '/api/events?ids=1,5,9,400&include=breakdown,distributions', None, set(), False),
+    ('events api page', 'GET', '/api/events?period=annual&year=2023&org_id=3&fields=event_name', None, set(), False),
+    ('events bulk status', 'JSON', '/api/events/bulk', {'ids': [5, 6, 7], 'action': 'status', 'status': 'Completed'},
+     set(), False),
+    ('events bulk delete', 'JSON', '/api/events/bulk', {'ids': [8, 9], 'action': 'delete'}, set(), False),
+]
+
+EXPLAINABLE = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+
+
+def seed(path, events):
+    """Fill a fresh database at path with events and their detail"""
+    database.DATABASE = path
+    init_db()
+    rng = random.Random(1)
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO organizations (name) VALUES (?)', [(f'Org {i}',) for i in range(50)])
+    conn.executemany('INSERT INTO volunteers (name, email) VALUES (?, ?)',
+                     [(f'Volunteer {i}', f'v{i}@example.org') for i in range(events // 10)])
+
+    first = date(2019, 1, 1)
+    rows = []
+    for i in range(events):
+        event_date = (first + timedelta(days=rng.randrange(365 * 7))).isoformat()
+        quarter, year, _ = calculate_quarter(event_date)
+        rows.append((f'Event {i}', event_date, rng.randint(1, 4), rng.randint(1, 50), rng.randint(0, 200), quarter, year))
+    conn.executemany('''
+        INSERT INTO event_profiles (event_name, event_date, event_type_id, organization_id, actual_participants, quarter, year)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+    entries = []
+    for event_id in range(1, events + 1):
+        for _ in range(5):
+            cost_type_id = rng.randint(1, 7)
+            hours = rng.choice([0, 1, 2, 4])
+            entries.append((event_id, cost_type_id, hours, 15 if hours else 0, rng.uniform(5, 200),
+                            rng.randint(1, events // 10), int(cost_type_id == 4)))
+    conn.executemany('''
+        INSERT INTO cost_entries (event_id, cost_type_id, hours, rate_per_hour, amount, volunteer_id, is_income)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', entries)
+    conn.execute('UPDATE cost_entries SET cost_type_name = (SELECT name FROM cost_types WHERE id = cost_entries.cost_type_id)')
+    conn.executemany('INSERT INTO profit_distributions (event_id, target_type, percentage) VALUES (?, ?, ?)',
+                     [(event_id, 'General Fund', 50) for event_id in range(1, events + 1)])
+    conn.commit()
+    conn.close()
+
+
+def explain(conn, sql):
+    """EXPLAIN QUERY PLAN rows as (depth, detail)"""
+    plan = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in plan:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append((depth[node_id], detail))
+    return lines
+
+
+def problems(plan, allow_scan, allow_sort):
+    scans = set()
+    for _, detail in plan:
+        match = re.match(r'SCAN (\w+)', detail)
+        if match:
+            table = ALIASES.get(match.group(1), match.group(1))
+            if table in BIG_TABLES:
+                scans.add(table)
+    found = [f'full scan of {t}' for t in sorted(scans - allow_scan)]
+    if scans and not allow_sort and any(re.match(r'USE TEMP B-TREE FOR (.*ORDER BY|GROUP BY|DISTINCT)', d) for _, d in plan):
+        found.append('temp B-tree sort over a full scan')
+    return found
+
+
+def run(events, verbose):
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'plans.db')
+    print(f"Seeding {events} events into {path} ...")
+    seed(path, events)
+
+    from app import app
+    client = app.test_client()
+    explain_conn = sqlite3.connect(path)
+    statements = []
+    database.SQL_TRACE = statements.append
+
+    failures = 0
+    for label, method, url, data, allow_scan, allow_sort in ROUTES:
+        statements.clear()
+        if method == 'GET':
+            response = client.get(url)
+        elif method == 'JSON':
+            response = client.post(url, json=data)
+        else:
+            response = client.post(url, data=data)
+        response.get_data()  # drain streamed pages so every query runs
+
+        report = []
+        route_failed = response.status_code >= 500
+        seen = set()
+        for sql in statements:
+            sql = sql.strip()
+            if sql in seen or not sql.upper().startswith(EXPLAINABLE):
+                continue
+            seen.add(sql)
+            try:
+                plan = explain(explain_conn, sql)
+            except sqlite3.Error as e:
+                report.append((' '.join(sql.split())[:110], [(0, f'(not explained: {e})')], []))
+                continue
+            found = problems(plan, allow_scan, allow_sort)
+            route_failed = route_failed or bool(found)
+            report.append((' '.join(sql.split())[:110], plan, found))
+
+        failures += route_failed
+        if verbose or route_failed:
+            print(f"\n{'FAIL' if route_failed else 'ok  '} {label}: {method} {url} -> {response.status_code}")
+            for sql, plan, found in report:
+                if not verbose and not found:
+                    continue
+                print(f"    {sql}")
+                for depth, detail in plan:
+                    print(f"        {'  ' * depth}{detail}")
+                for problem in found:
+                    print(f"        !! {problem}")
+        else:
+            print(f"ok   {label}")
+
+    database.SQL_TRACE = None
+    explain_conn.close()
+    print(f"\n{len(ROUTES) - failures}/{len(ROUTES)} routes passed")
+    return failures == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check route query plans for full table scans')
+    parser.add_argument('--events', type=int, default=20000, help='events to seed (5 cost entries each)')
+    parser.add_argument('--verbose', action='store_true', help='print every plan, not just problems')
+    args = parser.parse_args()
+    sys.exit(0 if run(args.events, args.verbose) else 1)
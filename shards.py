@@ -0,0 +1,324 @@
+"""Optional per-organization sharding.
+
+With SHARDS_DIR set, each organization's events, cost entries and
+distributions (and their change log) live in their own SQLite file,
+SHARDS_DIR/org_<id>.db (org_0.db holds events without an organization).
+Reference data - organizations, event and cost types, volunteers, lens
+categories, archive summaries - stays in the common database, which every
+shard connection attaches as "common". SQLite looks unqualified table names
+up in attached databases too, so the app's queries run unchanged on a shard.
+
+- A request that names an event, cost entry or distribution in its URL, or
+  an organization (?org_id=, or the organization of a new event), is routed
+  to that organization's shard; writes to one organization never wait on
+  another's.
+- Pages that span organizations fan out: the same query runs on every shard
+  (and the common database) in a thread pool and the partial aggregates are
+  merged.
+- Rows created in a shard take ids from its own range, (org + 1) * ID_SPAN
+  upwards, so an id says where its row lives. Rows moved by `split` or by
+  changing an event's organization keep their id and are found through
+  shard_directory in the common database.
+
+Move an existing database into shards (run it before serving requests):
+    SHARDS_DIR=shards python shards.py split
+    SHARDS_DIR=shards python shards.py list
+
+archive.py works on the unsharded database only - archive closed years
+before splitting. backup.py copies the shard files along with the common
+database.
+"""
+import argparse
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, has_app_context, request
+
+import budget
+import database
+from database import get_db, init_db, add_column
+from events_api import chunks
+
+# tables split by organization, and the column tying each row to its event
+SHARDED_TABLES = ['event_profiles', 'cost_entries', 'profit_distributions']
+# tables every shard has (its own change log too)
+SHARD_SCHEMA_TABLES = SHARDED_TABLES + ['change_log']
+EVENT_KEYS = {'event_profiles': 'id', 'cost_entries': 'event_id', 'profit_distributions': 'event_id'}
+
+# URL arguments naming a sharded row
+ROW_ARGS = {'event_id': 'event_profiles', 'cost_id': 'cost_entries', 'dist_id': 'profit_distributions'}
+
+# endpoints that create an event in the posted organization's shard
+NEW_EVENT_ENDPOINTS = {'add_event'}
+
+UNASSIGNED = 0
+ID_SPAN = 10 ** 9
+THREADS = int(os.environ.get('SHARD_THREADS', 8))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def enabled():
+    return bool(database.SHARDS_DIR)
+
+
+def shard_path(org_id):
+    return os.path.join(database.SHARDS_DIR, f'org_{org_id or UNASSIGNED}.db')
+
+
+def shard_orgs():
+    """Organizations that have a shard file"""
+    if not enabled() or not os.path.isdir(database.SHARDS_DIR):
+        return []
+    matches = (re.fullmatch(r'org_(\d+)\.db', name) for name in os.listdir(database.SHARDS_DIR))
+    return sorted(int(m.group(1)) for m in matches if m)
+
+
+def create_shard(org_id):
+    """Create an organization's shard file, if missing, with the common database's schema"""
+    path = shard_path(org_id)
+    if os.path.exists(path):
+        return path
+    os.makedirs(database.SHARDS_DIR, exist_ok=True)
+    # build it under a private name, then link it into place - two workers
+    # creating the same shard can't both win
+    partial = f'{path}.{os.getpid()}-{threading.get_ident()}.partial'
+    conn = get_db(shard=partial)
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    sync_schema(cursor)
+    # new rows get ids from this shard's own range
+    for table in SHARDED_TABLES:
+        cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, (org_id + 1) * ID_SPAN))
+    conn.commit()
+    conn.close()
+    try:
+        os.link(partial, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(partial)
+    return path
+
+
+def sync_schema(cursor):
+    """Bring a shard up to the common database's schema for its tables.
+
+    Creates missing tables, adds columns added to the common tables since
+    (add_column migrations), and creates or replaces indexes and triggers
+    whose definition changed.
+    """
+    cursor.execute(f'''
+        SELECT type, name, tbl_name, sql FROM common.sqlite_master
+        WHERE tbl_name IN ({','.join('?' * len(SHARD_SCHEMA_TABLES))}) AND sql IS NOT NULL
+        ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END
+    ''', SHARD_SCHEMA_TABLES)
+    for entry in cursor.fetchall():
+        cursor.execute('SELECT sql FROM main.sqlite_master WHERE type = ? AND name = ?', (entry['type'], entry['name']))
+        existing = cursor.fetchone()
+        if existing is None:
+            cursor.execute(entry['sql'])
+        elif entry['type'] == 'table':
+            # in the common table's column order, so both stay alike
+            cursor.execute(f"PRAGMA common.table_info({entry['name']})")
+            for column in cursor.fetchall():
+                decl = column['type'] + (f" DEFAULT {column['dflt_value']}" if column['dflt_value'] is not None else '')
+                add_column(cursor, entry['name'], column['name'], decl)
+        elif existing['sql'] != entry['sql']:
+            cursor.execute(f"DROP {entry['type'].upper()} main.{entry['name']}")
+            cursor.execute(entry['sql'])
+
+
+def migrate_shards():
+    """Apply the common database's schema changes to every shard (init_db runs this)"""
+    for org_id in shard_orgs():
+        conn = get_db(shard=shard_path(org_id))
+        sync_schema(conn.cursor())
+        conn.commit()
+        conn.close()
+
+
+def columns(cursor, table):
+    cursor.execute(f'PRAGMA main.table_info({table})')
+    return ', '.join(row['name'] for row in cursor.fetchall())
+
+
+def orgs_for_rows(table, ids):
+    """{row id: organization} for rows that live in a shard"""
+    found = {i: i // ID_SPAN - 1 for i in ids if i >= ID_SPAN}
+    conn = get_db()
+    cursor = conn.cursor()
+    for batch, placeholders in chunks(list(ids)):
+        cursor.execute(f'''
+            SELECT row_id, organization_id FROM shard_directory
+            WHERE table_name = ? AND row_id IN ({placeholders})
+        ''', [table] + batch)
+        found.update((row['row_id'], row['organization_id']) for row in cursor.fetchall())
+    conn.close()
+    return found
+
+
+def org_for_row(table, row_id):
+    """Organization whose shard holds a row, or None if it is still in the common database"""
+    return orgs_for_rows(table, [row_id]).get(row_id)
+
+
+def shard_groups(table, ids):
+    """Split ids by the shard holding them: {organization or None: [ids]}"""
+    orgs = orgs_for_rows(table, ids)
+    groups = {}
+    for i in ids:
+        groups.setdefault(orgs.get(i), []).append(i)
+    return groups
+
+
+def routed_shard():
+    # database.get_db() hook
+    return g.get('shard_path') if has_app_context() else None
+
+
+def route_request():
+    """Pin the request to one organization's shard when it names one"""
+    view_args = request.view_args or {}
+    for arg, table in ROW_ARGS.items():
+        if arg in view_args:
+            org_id = org_for_row(table, view_args[arg])
+            break
+    else:
+        org_id = request.args.get('org_id', type=int)
+        if request.method == 'POST' and request.endpoint in NEW_EVENT_ENDPOINTS:
+            org_id = request.form.get('organization_id', type=int) or UNASSIGNED
+            create_shard(org_id)
+    # an organization without a shard yet is still served from the common database
+    if org_id is not None and os.path.exists(shard_path(org_id)):
+        g.shard_org = org_id
+        g.shard_path = shard_path(org_id)
+
+
+def spans_shards():
+    """True when the running request isn't pinned to one shard, so reads must fan out"""
+    return enabled() and 'shard_path' not in g
+
+
+def needs_move(org_id):
+    """True if an event in this request's shard now belongs to another organization"""
+    return 'shard_org' in g and g.shard_org != (org_id or UNASSIGNED)
+
+
+def pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(THREADS, thread_name_prefix='shard')
+        return _pool
+
+
+def fan_out(fn, orgs=None):
+    """Run fn(cursor, org) on every shard in parallel; results come back in orgs order.
+
+    org None is the common database, which still answers for anything not
+    split into a shard yet. fn must return plain data (fetchall, not a cursor).
+    """
+    if orgs is None:
+        orgs = [None] + shard_orgs()
+    request_budget = budget.current()
+
+    def run(org_id):
+        conn = get_db(shard=shard_path(org_id) if org_id is not None else None)
+        # pool threads have no request context - hand the budget over
+        budget.install(conn, request_budget)
+        try:
+            return fn(conn.cursor(), org_id)
+        finally:
+            conn.close()
+
+    return list(pool().map(run, orgs))
+
+
+def transfer(conn, org_id, source, where, params=()):
+    """Move the events matching where, with their cost entries and distributions,
+    from schema source into the shard conn is open on; returns events moved"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT name, seq FROM main.sqlite_sequence')
+    sequences = cursor.fetchall()
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS moving (id INTEGER PRIMARY KEY)')
+    cursor.execute('DELETE FROM temp.moving')
+    cursor.execute(f'INSERT INTO temp.moving SELECT id FROM {source}.event_profiles ep WHERE {where}', params)
+    moved = cursor.rowcount
+    for table in SHARDED_TABLES:
+        rows = f'FROM {source}.{table} WHERE {EVENT_KEYS[table]} IN (SELECT id FROM temp.moving)'
+        # by name - a shard that missed a migration fails here instead of shifting columns
+        names = columns(cursor, table)
+        cursor.execute(f'INSERT INTO main.{table} ({names}) SELECT {names} {rows}')
+        cursor.execute(f'''
+            INSERT OR REPLACE INTO common.shard_directory (table_name, row_id, organization_id)
+            SELECT ?, id, ? {rows}
+        ''', (table, org_id))
+    for table in reversed(SHARDED_TABLES):
+        cursor.execute(f'DELETE FROM {source}.{table} WHERE {EVENT_KEYS[table]} IN (SELECT id FROM temp.moving)')
+    # rows brought in from another shard's id range mustn't move this shard's counter there
+    cursor.executemany('UPDATE main.sqlite_sequence SET seq = ? WHERE name = ?',
+                       [(row['seq'], row['name']) for row in sequences])
+    return moved
+
+
+def move_event(event_id, org_id):
+    """Move an event to another organization's shard (its organization changed)"""
+    org_id = org_id or UNASSIGNED
+    source = org_for_row('event_profiles', event_id)
+    if source == org_id:
+        return
+    conn = get_db(shard=create_shard(org_id))
+    schema = 'common'
+    if source is not None:
+        conn.execute('ATTACH DATABASE ? AS source', (shard_path(source),))
+        schema = 'source'
+    transfer(conn, org_id, schema, 'ep.id = ?', (event_id,))
+    conn.commit()
+    conn.close()
+
+
+def split():
+    """Move every event in the common database into its organization's shard"""
+    init_db()
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT DISTINCT COALESCE(organization_id, ?) FROM event_profiles', (UNASSIGNED,))
+    orgs = sorted(row[0] for row in cursor.fetchall())
+    conn.close()
+    moved = {}
+    for org_id in orgs:
+        conn = get_db(shard=create_shard(org_id))
+        moved[org_id] = transfer(conn, org_id, 'common', 'COALESCE(ep.organization_id, ?) = ?', (UNASSIGNED, org_id))
+        conn.commit()
+        conn.close()
+    return moved
+
+
+def init_sharding(app):
+    """Route requests to shards when SHARDS_DIR is set"""
+    if not enabled():
+        return
+    database.SHARD_ROUTER = routed_shard
+    app.before_request(route_request)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-organization shard files')
+    parser.add_argument('command', choices=['split', 'list'],
+                        help='split: move events out of the common database; list: show shards')
+    args = parser.parse_args()
+    if not enabled():
+        parser.error('set SHARDS_DIR to the directory for shard files')
+
+    if args.command == 'split':
+        for org_id, count in split().items():
+            print(f"org {org_id}: moved {count} events")
+    for org_id in shard_orgs():
+        conn = get_db(shard=shard_path(org_id))
+        events = conn.execute('SELECT COUNT(*) FROM main.event_profiles').fetchone()[0]
+        conn.close()
+        print(f"org {org_id}  {shard_path(org_id)}  {events} events  {os.path.getsize(shard_path(org_id))} bytes")
@@ -0,0 +1,63 @@
+"""Template caching.
+
+- Compiled templates are kept in a FileSystemBytecodeCache, so new
+  gunicorn workers and the desktop exe load bytecode instead of parsing
+  and compiling every template again.
+- {% cache 'name' %}...{% endcache %} renders a static section once per
+  process and reuses the HTML (used for the sidebar menus in base.html).
+  Fragments are not cached while templates auto-reload, so edits show up
+  during development.
+
+Warm the bytecode cache ahead of time (e.g. in a deploy step) with:
+    python templating.py
+"""
+import os
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache 'key' %} block whose rendered output is reused"""
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache={})
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', args), [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, key, caller):
+        if self.environment.auto_reload:
+            return caller()
+        cache = self.environment.fragment_cache
+        rv = cache.get(key)
+        if rv is None:
+            rv = cache[key] = caller()
+        return rv
+
+
+def init_templating(app, cache_dir):
+    """Set up the bytecode cache and fragment caching; call before the first render"""
+    os.makedirs(cache_dir, exist_ok=True)
+    extensions = list(app.jinja_options.get('extensions', [])) + [FragmentCacheExtension]
+    app.jinja_options = {**app.jinja_options,
+                         'bytecode_cache': FileSystemBytecodeCache(cache_dir),
+                         'extensions': extensions}
+
+
+def warm_templates(app):
+    """Compile every template so its bytecode is on disk"""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+if __name__ == '__main__':
+    from app import app
+    print(f"Compiled {warm_templates(app)} templates")